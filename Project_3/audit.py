@@ -8,11 +8,12 @@ Audit the keys 'addr:street', 'postcodes' and 'city' to remove errors and incons
 
 '''
 
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
 
+import osmstream
+
 #Auditing functions for street types
 
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -32,23 +33,25 @@ def is_street_name(elem):
 
 
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    for elem in osmstream.iter_elements(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
     return street_types
 
 
 # In[2]:
 
 OSM_FILE = 'new_delhi.osm'
-st_types = audit(OSM_FILE)
-pprint.pprint(dict(st_types))
+if __name__ == '__main__':
+    # The street, postcode and city audits below, with the tag count and key
+    # type audits of mapparser.py, in one pass over the file. auditors uses
+    # the functions above, so it is imported once they are defined
+    import auditors
+    report = auditors.run_audits(OSM_FILE)
+    st_types = report['street']
+    pprint.pprint(dict(st_types))
 
 
 # In[3]:
@@ -97,14 +100,14 @@ def update_street_name(name, mapping):
 
 # In[5]:
 
-def test():
-    st_types = audit(OSM_FILE)
+def test(st_types):
     for st_type, ways in st_types.iteritems():
         for name in ways:
             better_name = update_street_name(name, mapping)
             print name, "=>", better_name
 
-test()
+if __name__ == '__main__':
+    test(st_types)
 
 
 # In[10]:
@@ -116,25 +119,22 @@ def is_post_code(elem):
 
 
 def auditpostcode(osmfile):
-    osm_file = open(osmfile, "r")
     postcodes = {}
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_post_code(tag):
-                    if tag.attrib['v'] not in postcodes:
-                        postcodes[tag.attrib['v']]=1
-                    else:
-                        postcodes[tag.attrib['v']] +=1
-                    
-    osm_file.close()
+    for elem in osmstream.iter_elements(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_post_code(tag):
+                if tag.attrib['v'] not in postcodes:
+                    postcodes[tag.attrib['v']]=1
+                else:
+                    postcodes[tag.attrib['v']] +=1
     return postcodes
 
 
 # In[11]:
 
-postalcodes = auditpostcode(OSM_FILE)
-pprint.pprint(postalcodes)
+if __name__ == '__main__':
+    postalcodes = report['postcode']
+    pprint.pprint(postalcodes)
 
 
 # In[12]:
@@ -154,13 +154,13 @@ def update_postcode(postcode, mapping):
         postcode = postcode
     return postcode
         
-def test():
-    postalcodes = auditpostcode(OSM_FILE)
+def test(postalcodes):
     for k,v in postalcodes.iteritems():
         better_code = update_postcode(k,mapping2)
         print k, "=>", better_code
 
-test()
+if __name__ == '__main__':
+    test(postalcodes)
 
 
 # In[13]:
@@ -172,25 +172,22 @@ def is_city(elem):
 
 
 def auditcity(osmfile):
-    osm_file = open(osmfile, "r")
     city = {}
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_city(tag):
-                    if tag.attrib['v'] not in city:
-                        city[tag.attrib['v']]=1
-                    else:
-                        city[tag.attrib['v']] +=1
-                    
-    osm_file.close()
+    for elem in osmstream.iter_elements(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_city(tag):
+                if tag.attrib['v'] not in city:
+                    city[tag.attrib['v']]=1
+                else:
+                    city[tag.attrib['v']] +=1
     return city
 
 
 # In[14]:
 
-cities = auditcity(OSM_FILE)
-pprint.pprint(cities)
+if __name__ == '__main__':
+    cities = report['city']
+    pprint.pprint(cities)
 
 
 # In[15]:
@@ -212,13 +209,22 @@ def update_city(city, mapping):
         city = string_case(city)
     return city
 
-def test():
-    cities = auditcity(OSM_FILE)
+def test(cities):
     for k,v in cities.iteritems():
         better_city = update_city(k,mapping3)
         print k, "=>", better_city
 
-test()
+if __name__ == '__main__':
+    test(cities)
+
+
+# In[16]:
+
+# Tag counts and key types from the same pass, see mapparser.py
+
+if __name__ == '__main__':
+    pprint.pprint(report['tag_count'])
+    pprint.pprint(report['key_type'])
 
 
 # In[ ]:
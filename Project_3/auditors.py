@@ -0,0 +1,144 @@
+
+# coding: utf-8
+
+'''
+Run the street, postcode, city, tag count and key type audits of the OSM file
+together in a single streaming pass
+
+'''
+
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+
+import osmstream
+from audit import audit_street_type, is_city, is_post_code, is_street_name
+from mapparser import key_type
+
+# Registry of auditor classes by name, filled in by register_auditor
+
+AUDITORS = {}
+
+def register_auditor(name):
+    """Class decorator adding an auditor to the registry under name"""
+    def decorator(cls):
+        AUDITORS[name] = cls
+        return cls
+    return decorator
+
+
+class Auditor(object):
+    """Base auditor. Subclasses receive every top level element of the types
+    listed in `tags` through element() and return their findings from result()"""
+
+    __metaclass__ = ABCMeta
+
+    tags = ('node', 'way')
+
+    def element(self, elem):
+        pass
+
+    def finish(self, root):
+        pass
+
+    @abstractmethod
+    def result(self):
+        """The findings of the auditor once the whole file has been read"""
+
+
+class ValueCountAuditor(Auditor):
+    """Count the values of the tags picked by is_key"""
+
+    is_key = None
+
+    def __init__(self):
+        self.counts = {}
+
+    def element(self, elem):
+        for tag in elem.iter("tag"):
+            if self.is_key(tag):
+                v = tag.attrib['v']
+                self.counts[v] = self.counts.get(v, 0) + 1
+
+    def result(self):
+        return self.counts
+
+
+@register_auditor('street')
+class StreetAuditor(Auditor):
+    """Collect street names whose last word is not an expected street type"""
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def element(self, elem):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(self.street_types, tag.attrib['v'])
+
+    def result(self):
+        return self.street_types
+
+
+@register_auditor('postcode')
+class PostcodeAuditor(ValueCountAuditor):
+    is_key = staticmethod(is_post_code)
+
+
+@register_auditor('city')
+class CityAuditor(ValueCountAuditor):
+    is_key = staticmethod(is_city)
+
+
+@register_auditor('tag_count')
+class TagCountAuditor(Auditor):
+    """Count every element in the file by tag name"""
+
+    tags = None  # all top level elements
+
+    def __init__(self):
+        self.counts = {}
+
+    def element(self, elem):
+        for child in elem.iter():
+            self.counts[child.tag] = self.counts.get(child.tag, 0) + 1
+
+    def finish(self, root):
+        self.counts[root.tag] = self.counts.get(root.tag, 0) + 1
+
+    def result(self):
+        return self.counts
+
+
+@register_auditor('key_type')
+class KeyTypeAuditor(Auditor):
+    """Classify the 'k' attribute of every tag as lower, lower_colon,
+    problemchars or other"""
+
+    tags = None
+
+    def __init__(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def element(self, elem):
+        for tag in elem.iter("tag"):
+            key_type(tag, self.keys)
+
+    def result(self):
+        return self.keys
+
+
+def run_audits(osmfile, names=None, backend=None):
+    """Parse osmfile once, feeding each top level element to every auditor
+    in names (all registered auditors by default). Return {name: result}"""
+    names = sorted(AUDITORS) if names is None else names
+    auditors = [(name, AUDITORS[name]()) for name in names]
+
+    stream = osmstream.ElementStream(osmfile, backend=backend)
+    for elem in stream:
+        for _, auditor in auditors:
+            if auditor.tags is None or elem.tag in auditor.tags:
+                auditor.element(elem)
+
+    for _, auditor in auditors:
+        auditor.finish(stream.root)
+    return dict((name, auditor.result()) for name, auditor in auditors)
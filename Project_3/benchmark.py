@@ -0,0 +1,1105 @@
+
+# coding: utf-8
+
+'''
+Time the OSM processing steps against the way they were done before.
+
+    python benchmark.py --suite --sizes=10,100,1000 --save=results.json
+
+runs the whole pipeline on synthetic files of those sizes in MB and
+records the throughput and peak memory of each step; with
+--baseline=results.json it fails on regressions against an earlier run
+
+'''
+
+import bz2
+import codecs
+import csv
+import cStringIO
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import audit
+import auditors
+import columnar
+import data
+import mapparser
+import osmdb
+import osmstream
+import queries
+import synthetic
+import geometry
+import instrument
+import spatial
+
+SAMPLE_FILE = 'sample.osm'
+
+
+def best_time(func, *args, **kwargs):
+    """Return the best wall time in seconds of `repeat` calls of func"""
+    repeat = kwargs.pop('repeat', 3)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_audits_separately(osmfile):
+    """The audit functions of audit.py and mapparser.py, one full scan of
+    the file each"""
+    return {
+        'street': audit.audit(osmfile),
+        'postcode': audit.auditpostcode(osmfile),
+        'city': audit.auditcity(osmfile),
+        'tag_count': mapparser.count_tags(osmfile),
+        'key_type': mapparser.process_map(osmfile),
+    }
+
+
+def benchmark_audits(osmfile, repeat=3):
+    separate_results = run_audits_separately(osmfile)
+    assert separate_results == auditors.run_audits(osmfile), "single pass audits differ"
+    separate = best_time(run_audits_separately, osmfile, repeat=repeat)
+    single = best_time(auditors.run_audits, osmfile, repeat=repeat)
+    print "Audits, one scan per auditor: %.3f s" % separate
+    print "Audits, single pass:          %.3f s" % single
+    print "Speedup: %.2fx" % (separate / single)
+    return separate, single
+
+
+@contextmanager
+def temp_directory():
+    """Run in a new temporary directory, removed afterwards. data.process_map
+    writes its csv files to the working directory, where they would replace
+    those of a real conversion"""
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='osm_bench_')
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+def benchmark_process_map(osmfile, workers=(1, 2, 4, 8), repeat=1):
+    """Conversion throughput of data.process_map for each worker count"""
+    osmfile = os.path.abspath(osmfile)
+    size_mb = os.path.getsize(osmfile) / float(2 ** 20)
+    results = {}
+    with temp_directory():
+        for count in workers:
+            elapsed = best_time(data.process_map, osmfile, False, workers=count, repeat=repeat)
+            results[count] = elapsed
+            print "process_map, %2d worker(s): %.3f s, %.1f MB/s, %.2fx" % (
+                count, elapsed, size_mb / elapsed, results[workers[0]] / elapsed)
+    return results
+
+
+def csv_digest(compression=None):
+    """md5 of the uncompressed content of the csv files of process_map in
+    the working directory"""
+    digest = hashlib.md5()
+    for path in data.CSV_PATHS:
+        path = data.csvout.output_path(path, compression)
+        f = gzip.open(path, 'rb') if compression == 'gzip' else open(path, 'rb')
+        with f:
+            for block in iter(lambda: f.read(2 ** 20), ''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def benchmark_pipeline(osmfile, threads=(1, 2), compressions=(None, 'gzip'), repeat=3):
+    """data.process_map on one thread against the thread pipeline with each
+    number of shaping threads, writing plain and compressed csv files. The
+    files must be the same either way"""
+    osmfile = os.path.abspath(osmfile)
+    results = {}
+    with temp_directory():
+        for compression in compressions:
+            # Alternate the runs, as timings drift more than they differ
+            times = dict((count, []) for count in (0,) + tuple(threads))
+            digests = {}
+            for _ in range(repeat):
+                for count in sorted(times):
+                    times[count].append(best_time(data.process_map, osmfile, False,
+                                                  compression=compression, threads=count,
+                                                  repeat=1))
+                    digests[count] = csv_digest(compression)
+            if len(set(digests.itervalues())) != 1:
+                raise AssertionError("The thread pipeline changed the csv files")
+            single = results[compression, 0] = min(times[0])
+            print "process_map, %s output: one thread %.3f s" % (compression or 'plain', single)
+            for count in threads:
+                elapsed = results[compression, count] = min(times[count])
+                print "  pipeline, %d shaping thread(s): %.3f s (%+.1f%%)" % (
+                    count, elapsed, (elapsed / single - 1) * 100)
+    return results
+
+
+def tag_values(osmfile, keys):
+    """List the values of the node and way tags with each of keys"""
+    values = dict((k, []) for k in keys)
+    for element in osmstream.iter_elements(osmfile, tags=('node', 'way')):
+        for tag in element.iter("tag"):
+            if tag.attrib['k'] in values:
+                values[tag.attrib['k']].append(tag.attrib['v'])
+    return values
+
+
+def benchmark_cleaners(osmfile, passes=100, repeat=3):
+    """Time the tag cleaners of data.py with and without their LRU cache over
+    every street, postcode and city value in osmfile, `passes` times over"""
+    values = tag_values(osmfile, data.TAG_CLEANERS)
+
+    def run(cached, passes):
+        for k, cleaner in data.TAG_CLEANERS.iteritems():
+            if cached:
+                cleaner.clear()
+            else:
+                cleaner = cleaner.func
+            for _ in xrange(passes):
+                for v in values[k]:
+                    cleaner(v)
+
+    # Hit rate of a single pass over the file
+    run(True, 1)
+    for k, info in sorted(data.cleaner_cache_info().iteritems()):
+        calls = info.hits + info.misses
+        print "%-14s %7d values, hit rate %5.1f%%" % (
+            k, calls, 100.0 * info.hits / calls if calls else 0.0)
+
+    uncached = best_time(run, False, passes, repeat=repeat)
+    cached = best_time(run, True, passes, repeat=repeat)
+    print "Cleaners uncached: %.4f s, cached: %.4f s, speedup %.2fx" % (
+        uncached, cached, uncached / cached)
+    return uncached, cached
+
+
+def shape_all(osmfile, backend):
+    for element in data.get_element(osmfile, tags=('node', 'way'), backend=backend):
+        data.shape_element(element)
+
+
+def benchmark_backends(osmfile, repeat=3):
+    """Throughput and peak memory of each parser backend, reading and
+    shaping every node and way of osmfile"""
+    size_mb = os.path.getsize(osmfile) / float(2 ** 20)
+    results = {}
+    for backend in sorted(osmstream.BACKENDS):
+        if backend == 'lxml' and osmstream.lxml_etree is None:
+            continue
+        elapsed = best_time(shape_all, osmfile, backend, repeat=repeat)
+        rss = peak_rss(shape_all, osmfile, backend)
+        results[backend] = (elapsed, rss)
+        print "%-6s %.3f s, %.1f MB/s, peak RSS %d kB" % (backend, elapsed, size_mb / elapsed, rss)
+    return results
+
+
+def shaped_size(obj):
+    """Number of container objects (dicts, lists, tuples, records, arrays)
+    making up a shaped element, and their size in bytes, leaf values apart"""
+    if isinstance(obj, dict):
+        items = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        items = obj
+    elif isinstance(obj, (data.NodeRecord, data.WayRecord)):
+        items = [getattr(obj, slot) for slot in obj.__slots__]
+    elif isinstance(obj, data.array):
+        return 1, sys.getsizeof(obj)
+    else:
+        return 0, 0
+    count, size = 1, sys.getsizeof(obj)
+    for item in items:
+        item_count, item_size = shaped_size(item)
+        count += item_count
+        size += item_size
+    return count, size
+
+
+def shape_to_csv(osmfile, directory, compact):
+    elements = data.get_element(osmfile, tags=('node', 'way'))
+    data.shape_to_csv(elements, data.shard_paths(directory, 0), validate=False,
+                      compact=compact)
+
+
+def benchmark_records(osmfile, directory='.', repeat=3):
+    """Objects and bytes per shaped element, and shaping plus csv writing
+    throughput, for the compact records against the shape_element dicts"""
+    classifier = data.key_classifier()
+    totals = {'dicts': [0, 0, 0], 'records': [0, 0, 0]}
+    for element in data.get_element(osmfile, tags=('node', 'way')):
+        for name, shaped in (('dicts', data.shape_element(element)),
+                             ('records', data.shape_record(element, classifier))):
+            count, size = shaped_size(shaped)
+            totals[name][0] += 1
+            totals[name][1] += count
+            totals[name][2] += size
+
+    size_mb = os.path.getsize(osmfile) / float(2 ** 20)
+    results = {}
+    for name, compact in (('dicts', False), ('records', True)):
+        elements, count, size = totals[name]
+        elapsed = best_time(shape_to_csv, osmfile, directory, compact, repeat=repeat)
+        results[name] = (count / float(elements), size / float(elements), elapsed)
+        print "%-7s %.1f objects, %.0f bytes per element, %.3f s (%.1f MB/s) to csv" % (
+            name, count / float(elements), size / float(elements), elapsed, size_mb / elapsed)
+    for path in data.shard_paths(directory, 0):
+        os.remove(path)
+    return results
+
+
+def shape_validated(osmfile, validate, validator=None, validate_every=1):
+    elements = data.get_element(osmfile, tags=('node', 'way'))
+    for _ in data.shaped_elements(elements, validate, validate_every=validate_every,
+                                  validator=validator):
+        pass
+
+
+def check_validators(osmfile):
+    """Check that the compiled validator accepts and rejects exactly the
+    same shaped elements as cerberus, broken ones included. Skipped if
+    cerberus is not installed"""
+    try:
+        import cerberus
+    except ImportError:
+        print "cerberus is not installed, compiled validator not compared"
+        return
+    compiled = data.schemacheck.CompiledValidator(data.SCHEMA)
+    reference = cerberus.Validator()
+    broken = [
+        {'node': {'id': '1', 'lat': 'x'}},
+        {'node_tags': [{'id': '1', 'key': 1, 'value': 'a', 'type': 'b', 'extra': 'c'}]},
+        {'way_nodes': [{'id': '1', 'node_id': None, 'position': 0}]},
+    ]
+    elements = data.get_element(osmfile, tags=data.ELEMENT_TAGS)
+    shaped = [el for _, el in data.shaped_elements(elements, False) if el] + broken
+    for el in shaped:
+        expected = reference.validate(el, data.SCHEMA)
+        if compiled.validate(el) != expected or sorted(compiled.errors) != sorted(reference.errors):
+            raise AssertionError("Validators disagree on %r" % el)
+    print "Compiled validator agrees with cerberus on %d elements" % len(shaped)
+
+
+def benchmark_validation(osmfile, every=100, repeat=3):
+    """Shaping time of every node and way of osmfile without validation,
+    with cerberus, with the compiled validator and with the compiled
+    validator on one element in every. cerberus is left out if it is not
+    installed"""
+    try:
+        import cerberus
+    except ImportError:
+        cerberus = None
+    check_validators(osmfile)
+    base = best_time(shape_validated, osmfile, False, repeat=repeat)
+    results = {'none': base}
+    print "no validation        %.3f s" % base
+    validators = [('compiled', None, 1), ('compiled 1/%d' % every, None, every)]
+    if cerberus is not None:
+        validators.insert(0, ('cerberus', cerberus.Validator(), 1))
+    for name, validator, validate_every in validators:
+        elapsed = best_time(shape_validated, osmfile, True, validator, validate_every,
+                            repeat=repeat)
+        results[name] = elapsed
+        print "%-20s %.3f s (+%.0f%%)" % (name, elapsed, 100 * (elapsed / base - 1))
+    return results
+
+
+class UnicodeDictWriter(csv.DictWriter, object):
+    """The csv writer data.py used before csvout, for comparison"""
+
+    def writerow(self, row):
+        super(UnicodeDictWriter, self).writerow({
+            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
+        })
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def write_dicts_legacy(shaped, paths):
+    files = [codecs.open(path, 'w') for path in paths]
+    writers = [UnicodeDictWriter(f, fields) for f, fields in zip(files, data.CSV_FIELDS)]
+    (nodes, node_tags, ways, way_nodes, way_tags,
+     relations, relation_tags, relation_members) = writers
+    for writer in writers:
+        writer.writeheader()
+    for tag, el in shaped:
+        if tag == 'node':
+            nodes.writerow(el['node'])
+            node_tags.writerows(el['node_tags'])
+        elif tag == 'way':
+            ways.writerow(el['way'])
+            way_nodes.writerows(el['way_nodes'])
+            way_tags.writerows(el['way_tags'])
+        else:
+            relations.writerow(el['relation'])
+            relation_members.writerows(el['relation_members'])
+            relation_tags.writerows(el['relation_tags'])
+    for f in files:
+        f.close()
+
+
+def benchmark_csv_writers(osmfile, directory='.', repeat=3):
+    """Time spent writing the csv files only, from elements shaped in advance:
+    the former UnicodeDictWriter, the buffered tuple writer fed from dicts and
+    from compact records, and the latter compressed"""
+    elements = list(data.get_element(osmfile, tags=data.ELEMENT_TAGS))
+    shaped = [(element.tag, data.shape_element(element)) for element in elements]
+    classifier = data.key_classifier()
+    records = [data.shape_record(element, classifier) for element in elements]
+    del elements
+
+    paths = data.shard_paths(directory, 0)
+    base = best_time(write_dicts_legacy, shaped, paths, repeat=repeat)
+    print "%-24s %.3f s" % ('UnicodeDictWriter', base)
+    results = {'UnicodeDictWriter': base}
+    for name, func, args in (
+            ('buffered, dicts', data.shaped_to_csv, (shaped, paths)),
+            ('buffered, records', data.records_to_csv, (records, paths)),
+            ('buffered, records, gzip', data.records_to_csv, (records, paths, True, 'gzip')),
+            ('buffered, records, zstd', data.records_to_csv, (records, paths, True, 'zstd'))):
+        elapsed = best_time(func, *args, repeat=repeat)
+        results[name] = elapsed
+        print "%-24s %.3f s (%.1fx)" % (name, elapsed, base / elapsed)
+    for compression in data.csvout.SUFFIXES:
+        for path in paths:
+            path = data.csvout.output_path(path, compression)
+            if os.path.exists(path):
+                os.remove(path)
+    return results
+
+
+# The queries run by sqlqueries.py
+
+def tag_values_sql(key, limit=10, alias='t'):
+    sql = ('SELECT {0}.value, COUNT(*) as count FROM (SELECT * FROM nodes_tags UNION ALL '
+           'SELECT * FROM ways_tags) {0} WHERE {0}.key="%s" GROUP BY {0}.value '
+           'ORDER BY count DESC' % key).format(alias)
+    return sql + (' LIMIT %d;' % limit if limit else ';')
+
+REPORT_QUERIES = [
+    ('nodes', 'SELECT COUNT(*) FROM nodes'),
+    ('ways', 'SELECT COUNT(*) FROM ways'),
+    ('node tags', 'SELECT COUNT(*) FROM nodes_tags'),
+    ('way tags', 'SELECT COUNT(*) FROM ways_tags'),
+    ('unique users', 'SELECT COUNT(DISTINCT(e.uid)) '
+                     'FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) e'),
+    ('top users', 'SELECT e.user, COUNT(*) as num '
+                  'FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e '
+                  'GROUP BY e.user ORDER BY num DESC LIMIT 10'),
+    ('users contributing once', 'SELECT COUNT(*) FROM (SELECT e.user, COUNT(*) as num '
+                                'FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e '
+                                'GROUP BY e.user HAVING num=1) u'),
+    ('postcodes', tag_values_sql('postcode')),
+    ('amenities', tag_values_sql('amenity')),
+    ('religions', tag_values_sql('religion', alias='e')),
+    ('cuisine', tag_values_sql('cuisine', limit=5)),
+    ('historic', tag_values_sql('historic', limit=None, alias='tags')),
+]
+
+# Tables as database.py used to create them: no types, keys or indexes
+UNTYPED_SCHEMA = dict((table, 'CREATE TABLE %s (%s);' % (table, ', '.join(fields)))
+                      for table, fields in osmdb.TABLES)
+
+
+def time_queries(sqlite_file, queries=REPORT_QUERIES, repeat=5):
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        return [(name, best_time(lambda: conn.execute(sql).fetchall(), repeat=repeat))
+                for name, sql in queries]
+    finally:
+        conn.close()
+
+
+def benchmark_schema(osmfile, directory='.', repeat=5):
+    """Time every sqlqueries.py query on the untyped, unindexed tables and on
+    the typed and indexed ones"""
+    before_db = os.path.join(directory, 'bench_untyped.db')
+    after_db = os.path.join(directory, 'bench_typed.db')
+    osmdb.load_osm(osmfile, before_db, schema=UNTYPED_SCHEMA, indexes=[])
+    osmdb.load_osm(osmfile, after_db)
+    try:
+        before = time_queries(before_db, repeat=repeat)
+        after = time_queries(after_db, repeat=repeat)
+    finally:
+        os.remove(before_db)
+        os.remove(after_db)
+    for (name, old), (_, new) in zip(before, after):
+        print "%-24s before %8.2f ms, after %8.2f ms, %6.1fx" % (
+            name, old * 1000, new * 1000, old / new if new else float('inf'))
+    return before, after
+
+
+def summary_sql(key, limit=10):
+    sql = ('SELECT value, count FROM tag_value_counts WHERE key="%s" '
+           'ORDER BY count DESC, value DESC' % key)
+    return sql + (' LIMIT %d;' % limit if limit else ';')
+
+TAG_REPORTS = [('postcodes', 'postcode', 10), ('amenities', 'amenity', 10),
+               ('religions', 'religion', 10), ('cuisine', 'cuisine', 5),
+               ('historic', 'historic', None)]
+
+
+def benchmark_tag_summary(osmfile, directory='.', repeat=5):
+    """Time the per-key tag reports scanning both tag tables against reading
+    them from tag_value_counts"""
+    sqlite_file = os.path.join(directory, 'bench_summary.db')
+    osmdb.load_osm(osmfile, sqlite_file)
+    try:
+        scans = time_queries(sqlite_file, [(name, tag_values_sql(key, limit))
+                                           for name, key, limit in TAG_REPORTS], repeat)
+        lookups = time_queries(sqlite_file, [(name, summary_sql(key, limit))
+                                             for name, key, limit in TAG_REPORTS], repeat)
+    finally:
+        os.remove(sqlite_file)
+    for (name, scan), (_, lookup) in zip(scans, lookups):
+        print "%-10s union scan %8.2f ms, summary %6.3f ms" % (name, scan * 1000, lookup * 1000)
+    return scans, lookups
+
+
+def columnar_reports(directory, format):
+    return [
+        ('nodes', lambda: columnar.row_count(directory, 'nodes', format)),
+        ('ways', lambda: columnar.row_count(directory, 'ways', format)),
+        ('node tags', lambda: columnar.row_count(directory, 'nodes_tags', format)),
+        ('way tags', lambda: columnar.row_count(directory, 'ways_tags', format)),
+        ('unique users', lambda: columnar.number_of_unique_users(directory, format)),
+        ('top users', lambda: columnar.top_contributing_users(directory, 10, format)),
+        ('users contributing once',
+         lambda: columnar.number_of_users_contributing_once(directory, format)),
+    ] + [(name, lambda key=key, limit=limit: columnar.top_tag_values(directory, key, limit, format))
+         for name, key, limit in TAG_REPORTS]
+
+
+def benchmark_columnar(osmfile, directory='.', repeat=5):
+    """Size and write time of the csv, Parquet and Arrow outputs, and time of
+    the sqlqueries.py reports from the typed sqlite tables and from the files"""
+    csv_dir = os.path.join(directory, 'bench_csv')
+    os.mkdir(csv_dir)
+    sqlite_file = os.path.join(directory, 'bench_columnar.db')
+    try:
+        paths = [os.path.join(csv_dir, os.path.basename(path)) for path in data.CSV_PATHS]
+        elapsed = best_time(lambda: data.shape_to_csv(
+            data.get_element(osmfile, tags=('node', 'way')), paths, False), repeat=1)
+        print "%-8s write %.2f s, %8d bytes" % (
+            'csv', elapsed, sum(os.path.getsize(path) for path in paths))
+        for format in sorted(columnar.SUFFIXES):
+            elapsed = best_time(lambda: data.shape_to_csv(
+                data.get_element(osmfile, tags=('node', 'way')), paths, False, format=format),
+                repeat=1)
+            size = sum(os.path.getsize(columnar.table_path(csv_dir, table, format))
+                       for table in columnar.TABLE_CSV_PATHS)
+            print "%-8s write %.2f s, %8d bytes" % (format, elapsed, size)
+
+        osmdb.load_osm(osmfile, sqlite_file)
+        queries = dict(REPORT_QUERIES)
+        queries.update((name, summary_sql(key, limit)) for name, key, limit in TAG_REPORTS)
+        sql_times = dict(time_queries(sqlite_file, queries.items(), repeat))
+        file_times = dict((format, dict((name, best_time(report, repeat=repeat))
+                                        for name, report in columnar_reports(csv_dir, format)))
+                          for format in columnar.SUFFIXES)
+        for name, _ in columnar_reports(csv_dir, 'parquet'):
+            print "%-24s sqlite %8.2f ms, parquet %8.2f ms, arrow %8.2f ms" % (
+                name, sql_times[name] * 1000, file_times['parquet'][name] * 1000,
+                file_times['arrow'][name] * 1000)
+    finally:
+        shutil.rmtree(csv_dir)
+        if os.path.exists(sqlite_file):
+            os.remove(sqlite_file)
+    return sql_times, file_times
+
+
+def report_calls(db):
+    """The sqlqueries.py reports as calls on a queries.OSMQueries"""
+    return [
+        ('nodes', lambda: db.row_count('nodes')),
+        ('ways', lambda: db.row_count('ways')),
+        ('node tags', lambda: db.row_count('nodes_tags')),
+        ('way tags', lambda: db.row_count('ways_tags')),
+        ('unique users', db.number_of_unique_users),
+        ('top users', lambda: db.top_contributors(10)),
+        ('users contributing once', db.number_of_users_contributing_once),
+    ] + [(name, lambda key=key, limit=limit: db.top_tag_values(key, limit))
+         for name, key, limit in TAG_REPORTS]
+
+
+def benchmark_queries(osmfile, directory='.', calls=200, threads=4):
+    """Time a round of the sqlqueries.py reports run as SQL strings on one
+    connection, through OSMQueries with the cache off, and through
+    OSMQueries answering from its cache. Results must agree, the cache must
+    drop results once the database changes, and the pool must give the same
+    answers to concurrent threads"""
+    sqlite_file = os.path.join(directory, 'bench_queries.db')
+    osmdb.load_osm(osmfile, sqlite_file)
+    conn = sqlite3.connect(sqlite_file)
+    uncached = queries.OSMQueries(sqlite_file, cache_size=0)
+    cached = queries.OSMQueries(sqlite_file)
+    try:
+        sql = dict(REPORT_QUERIES)
+        sql.update((name, summary_sql(key, limit)) for name, key, limit in TAG_REPORTS)
+        names = [name for name, _ in report_calls(cached)]
+        expected = []
+        for name in names:
+            rows = conn.execute(sql[name]).fetchall()
+            # Counts come back as numbers, the other reports as rows
+            expected.append(rows[0][0] if len(rows) == 1 and len(rows[0]) == 1 else rows)
+        for db in (uncached, cached):
+            if [call() for _, call in report_calls(db)] != expected:
+                raise AssertionError("OSMQueries results differ from sqlqueries.py")
+
+        def strings():
+            for name in names:
+                conn.execute(sql[name]).fetchall()
+        rounds = [('sql strings', strings)] + [
+            (label, lambda db=db: [call() for _, call in report_calls(db)])
+            for label, db in (('pooled', uncached), ('cached', cached))]
+        times = dict((label, best_time(func, repeat=calls) * 1000) for label, func in rounds)
+        for label, _ in rounds:
+            print "%-12s %8.3f ms per round of %d reports" % (label, times[label], len(names))
+        print "cache hits %d, misses %d" % (cached.cache.hits, cached.cache.misses)
+
+        # Changing the database must change the answers at once
+        with conn:
+            conn.execute("UPDATE tag_value_counts SET count = count + 1000 "
+                         "WHERE key = 'amenity'")
+        # Move the modification time on in case the clock is coarser than the test
+        os.utime(sqlite_file, (time.time(), time.time() + 1))
+        counts = [count for _, count in cached.top_tag_values('amenity')]
+        if counts != [count + 1000 for _, count in expected[names.index('amenities')]]:
+            raise AssertionError("Cached results survived a database change")
+
+        results, errors = [], []
+
+        def worker():
+            try:
+                for _ in range(calls // threads):
+                    results.append([call() for _, call in report_calls(uncached)])
+            except Exception as e:
+                errors.append(e)
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if errors or len(set(map(repr, results))) != 1:
+            raise AssertionError("Concurrent queries failed or disagree: %r" % errors[:1])
+        print "%d threads, %d rounds each: consistent" % (threads, calls // threads)
+    finally:
+        uncached.close()
+        cached.close()
+        conn.close()
+        os.remove(sqlite_file)
+    return times
+
+
+def scan_within(conn, lat, lon, radius, key=None, value=None):
+    """spatial.nodes_within without the spatial index: distance to every node"""
+    if key is None:
+        rows = conn.execute('SELECT id, lat, lon, NULL FROM nodes')
+    elif value is None:
+        rows = conn.execute('SELECT n.id, n.lat, n.lon, t.value FROM nodes n '
+                            'JOIN nodes_tags t ON t.id = n.id AND t.key = ?', (key,))
+    else:
+        rows = conn.execute('SELECT n.id, n.lat, n.lon, t.value FROM nodes n '
+                            'JOIN nodes_tags t ON t.id = n.id AND t.key = ? AND t.value = ?',
+                            (key, value))
+    found = [(node_id, node_lat, node_lon, tag_value,
+              spatial.haversine(lat, lon, node_lat, node_lon))
+             for node_id, node_lat, node_lon, tag_value in rows]
+    found.sort(key=lambda row: row[4])
+    return [row for row in found if row[4] <= radius]
+
+
+def scan_bbox(conn, min_lat, min_lon, max_lat, max_lon):
+    return conn.execute('SELECT id, lat, lon, NULL FROM nodes WHERE lat BETWEEN ? AND ? '
+                        'AND lon BETWEEN ? AND ?', (min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+
+def scan_nearest(conn, lat, lon, k=1, key=None, value=None):
+    return scan_within(conn, lat, lon, float('inf'), key, value)[:k]
+
+
+def benchmark_spatial(osmfile, directory='.', points=20, repeat=3, seed=0):
+    """Latency of bounding box, radius and nearest neighbour queries with the
+    spatial index against scanning every node, at random points around the
+    nodes of osmfile. Results must be the same either way"""
+    sqlite_file = os.path.join(directory, 'bench_spatial.db')
+    osmdb.load_osm(osmfile, sqlite_file)
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        rnd = random.Random(seed)
+        ids = [row[0] for row in conn.execute('SELECT id FROM nodes')]
+        centres = [conn.execute('SELECT lat, lon FROM nodes WHERE id = ?',
+                                (rnd.choice(ids),)).fetchone() for _ in range(points)]
+        key, value = conn.execute('SELECT key, value FROM nodes_tags GROUP BY key, value '
+                                  'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+        cases = [
+            ('bbox 1 km', lambda lat, lon: spatial.nodes_in_bbox(
+                conn, *spatial.radius_bbox(lat, lon, 500)),
+             lambda lat, lon: scan_bbox(conn, *spatial.radius_bbox(lat, lon, 500))),
+            ('radius 1 km', lambda lat, lon: spatial.nodes_within(conn, lat, lon, 1000),
+             lambda lat, lon: scan_within(conn, lat, lon, 1000)),
+            ('radius 1 km, %s' % key, lambda lat, lon: spatial.nodes_within(conn, lat, lon, 1000, key),
+             lambda lat, lon: scan_within(conn, lat, lon, 1000, key)),
+            ('5 nearest %s=%s' % (key, value),
+             lambda lat, lon: spatial.nearest_nodes(conn, lat, lon, 5, key, value),
+             lambda lat, lon: scan_nearest(conn, lat, lon, 5, key, value)),
+        ]
+        results = {}
+        for name, indexed, scan in cases:
+            for lat, lon in centres:
+                if sorted(indexed(lat, lon)) != sorted(scan(lat, lon)):
+                    raise AssertionError("%s differs at %s, %s" % (name, lat, lon))
+            times = [best_time(lambda: [func(lat, lon) for lat, lon in centres], repeat=repeat)
+                     / len(centres) for func in (indexed, scan)]
+            results[name] = times
+            print "%-32s rtree %8.3f ms, scan %8.2f ms" % (name, times[0] * 1000, times[1] * 1000)
+    finally:
+        conn.close()
+        os.remove(sqlite_file)
+    return results
+
+
+def join_geometries(sqlite_file):
+    """Way geometries the way they had to be built before: a join of
+    ways_nodes against nodes per way"""
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        way_ids = [row[0] for row in conn.execute('SELECT id FROM ways ORDER BY id')]
+        return dict((way_id, geometry.WayGeometry(conn.execute(
+            'SELECT n.lat, n.lon FROM ways_nodes w JOIN nodes n ON n.id = w.node_id '
+            'WHERE w.id = ? ORDER BY w.position', (way_id,)).fetchall()))
+            for way_id in way_ids)
+    finally:
+        conn.close()
+
+
+def benchmark_geometry(osmfile, directory='.', repeat=3):
+    """Cost of building the way geometry during the csv conversion, against
+    the conversion alone plus a join per way in the loaded database. Lengths
+    and boxes must agree"""
+    paths = data.shard_paths(directory, 0)
+    geometry_path = os.path.join(directory, 'bench_' + geometry.WAY_GEOMETRY_PATH)
+    sqlite_file = os.path.join(directory, 'bench_geometry.db')
+    convert = lambda path: data.shape_to_csv(data.get_element(osmfile, tags=('node', 'way')),
+                                             paths, False, geometry_path=path)
+    try:
+        # Alternate the two runs, as timings drift more than they differ
+        times = {None: [], geometry_path: []}
+        for _ in range(repeat):
+            for path in times:
+                times[path].append(best_time(convert, path, repeat=1))
+        plain, with_geometry = min(times[None]), min(times[geometry_path])
+        osmdb.load_osm(osmfile, sqlite_file)
+        start = time.time()
+        joined = join_geometries(sqlite_file)
+        join_time = time.time() - start
+
+        with open(geometry_path, 'rb') as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            expected = joined[int(row['id'])]
+            if int(row['missing_nodes']) == 0 and (
+                    row['length'] != '%.1f' % expected.length or
+                    row['min_lat'] != '%.7f' % expected.bbox[0]):
+                raise AssertionError("Way %s geometry differs" % row['id'])
+    finally:
+        for path in paths + [geometry_path, sqlite_file]:
+            if os.path.exists(path):
+                os.remove(path)
+    print "conversion %.3f s, with way geometry %.3f s (+%.3f s), join per way %.3f s (%d ways)" % (
+        plain, with_geometry, with_geometry - plain, join_time, len(rows))
+    return plain, with_geometry, join_time
+
+
+def benchmark_instrumentation(osmfile, directory='.', repeat=3):
+    """Cost of collecting run statistics during the csv conversion, and
+    check that the counts add up: the kept tags, way node refs and nodes
+    are the rows of the csv files, and the kept and dropped tags all the
+    tags of the file"""
+    paths = data.shard_paths(directory, 0)
+    convert = lambda stats: data.shape_to_csv(data.get_element(osmfile, tags=data.ELEMENT_TAGS),
+                                              paths, False, header=False, stats=stats)
+    try:
+        # Alternate the two runs, as timings drift more than they differ
+        times = {'plain': [], 'instrumented': []}
+        for _ in range(repeat):
+            times['plain'].append(best_time(convert, None, repeat=1))
+            stats = instrument.RunStats()
+            times['instrumented'].append(best_time(convert, stats, repeat=1))
+        stats.stop('write')
+        rows = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                rows.append(sum(1 for _ in f))
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    counters = stats.report()['counters']
+    with open(osmfile, 'rb') as f:
+        tags = sum(line.count('<tag ') for line in f)
+    nodes, node_tags, _, way_nodes, way_tags, _, relation_tags, _ = rows
+    if (counters['tags'] != tags or
+            counters['tags_kept'] != node_tags + way_tags + relation_tags or
+            counters['nd_refs'] != way_nodes or counters['nodes'] != nodes):
+        raise AssertionError("Run statistics do not match the output: %r" % dict(counters))
+    plain, instrumented = min(times['plain']), min(times['instrumented'])
+    print "conversion %.3f s, instrumented %.3f s (%+.1f%%)" % (
+        plain, instrumented, (instrumented / plain - 1) * 100)
+    for stage, seconds in sorted(stats.times.iteritems(), key=lambda item: -item[1]):
+        print "  %-10s %7.3f s %5.1f%%" % (stage, seconds, seconds / stats.seconds * 100)
+    print "  tags %d, dropped %d" % (counters['tags'], counters['tags'] - counters['tags_kept'])
+    return plain, instrumented, stats
+
+
+def compressed_copies(osmfile, directory):
+    """gzip and bzip2 copies of osmfile in directory, and xz and zstd ones
+    if those commands are installed. Return the paths by compression"""
+    base = os.path.join(directory, 'bench_' + os.path.basename(osmfile))
+    copies = {'gzip': (base + '.gz', gzip.open), 'bzip2': (base + '.bz2', bz2.BZ2File)}
+    paths = {}
+    for kind, (path, open_compressed) in sorted(copies.iteritems()):
+        with open(osmfile, 'rb') as f:
+            with open_compressed(path, 'wb') as out:
+                shutil.copyfileobj(f, out, 2 ** 20)
+        paths[kind] = path
+    for kind, suffix in (('xz', '.xz'), ('zstd', '.zst')):
+        path = base + suffix
+        try:
+            with open(osmfile, 'rb') as f:
+                with open(path, 'wb') as out:
+                    subprocess.check_call([kind, '-c'], stdin=f, stdout=out)
+        except (OSError, subprocess.CalledProcessError):
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        paths[kind] = path
+    return paths
+
+
+def gzip_member(content):
+    output = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=output, mode='wb') as f:
+        f.write(content)
+    return output.getvalue()
+
+
+def check_compressed_members(osmfile, directory='.', members=4):
+    """Copies of osmfile made of several gzip or bzip2 members, as pigz and
+    lbzip2 write them, must read back as osmfile, also when a member ends
+    exactly where a read of the compressed file does"""
+    with open(osmfile, 'rb') as f:
+        content = f.read()
+    size = max(1, -(-len(content) // members))
+    parts = [content[i:i + size] for i in xrange(0, len(content), size)]
+    read_size = osmstream.READ_SIZE
+    path = os.path.join(directory, 'bench_members_' + os.path.basename(osmfile))
+    try:
+        for kind, compress in (('gzip', gzip_member), ('bzip2', bz2.compress)):
+            compressed = [compress(part) for part in parts]
+            with open(path, 'wb') as f:
+                f.write(''.join(compressed))
+            # The default read size, then reads ending where the first and
+            # the second member end
+            for reads in (read_size, len(compressed[0]), len(compressed[0]) + len(compressed[1])):
+                osmstream.READ_SIZE = reads
+                reader = osmstream.open_osm(path)
+                try:
+                    if reader.read() != content:
+                        raise AssertionError("%d %s members read with %d byte reads differ from %s"
+                                             % (len(parts), kind, reads, osmfile))
+                finally:
+                    reader.close()
+    finally:
+        osmstream.READ_SIZE = read_size
+        if os.path.exists(path):
+            os.remove(path)
+    print "%d gzip and bzip2 members read back as %s" % (len(parts), osmfile)
+
+
+def count_elements(osm_file):
+    return sum(1 for _ in data.get_element(osm_file, tags=data.ELEMENT_TAGS))
+
+
+def benchmark_compressed_input(osmfile, directory='.', repeat=3):
+    """Parsing compressed copies of osmfile with the decompression on its
+    own thread or process, against decompressing on the parsing thread
+    with gzip.open and bz2.BZ2File, and scanning the raw spans of the
+    memory mapped file. Every copy must give the spans of the original"""
+    check_compressed_members(osmfile, directory)
+    paths = compressed_copies(osmfile, directory)
+    inline = {'gzip': gzip.open, 'bzip2': bz2.BZ2File}
+    try:
+        spans = list(osmstream.iter_spans(osmfile))
+        for kind, path in sorted(paths.iteritems()):
+            if list(osmstream.iter_spans(path)) != spans:
+                raise AssertionError("%s copy does not give the spans of %s" % (kind, osmfile))
+        plain = best_time(count_elements, osmfile, repeat=repeat)
+        scan = best_time(lambda: sum(1 for _ in osmstream.iter_spans(osmfile)), repeat=repeat)
+        print "plain      parse %.3f s, span scan (mmap) %.3f s, %d elements" % (
+            plain, scan, len(spans))
+        results = {None: (plain, None)}
+        for kind, path in sorted(paths.iteritems()):
+            piped = best_time(count_elements, path, repeat=repeat)
+            if kind in inline:
+                before = best_time(lambda: count_elements(inline[kind](path, 'rb')), repeat=repeat)
+                print "%-10s parse %.3f s, decompressing inline %.3f s (%+.1f%%), %.1f MB" % (
+                    kind, piped, before, (piped / before - 1) * 100,
+                    os.path.getsize(path) / float(2 ** 20))
+            else:
+                before = None
+                print "%-10s parse %.3f s, %.1f MB" % (
+                    kind, piped, os.path.getsize(path) / float(2 ** 20))
+            results[kind] = (piped, before)
+    finally:
+        for path in paths.itervalues():
+            if os.path.exists(path):
+                os.remove(path)
+    return results
+
+
+# Synthetic OSM files for memory checks and the benchmark suite
+
+def write_synthetic_osm(path, size_bytes, seed=0):
+    """Write an OSM XML file of about size_bytes, see synthetic"""
+    synthetic.write_osm(path, size_bytes, seed)
+    return path
+
+
+def _measure_worker(queue, func, args):
+    start = time.time()
+    try:
+        result = func(*args)
+    except Exception as e:
+        queue.put((None, None, None, '%s: %s' % (e.__class__.__name__, e)))
+        return
+    queue.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               result, None))
+
+
+def measure(func, *args):
+    """Run func(*args) in a fresh process. Return its wall time in seconds,
+    its peak RSS in kB and its result, which must pickle"""
+    queue = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=_measure_worker, args=(queue, func, args))
+    worker.start()
+    seconds, rss, result, error = queue.get()
+    worker.join()
+    if error is not None:
+        raise RuntimeError("%s failed: %s" % (func.__name__, error))
+    return seconds, rss, result
+
+
+def peak_rss(func, *args):
+    """Run func(*args) in a fresh process and return its peak RSS in kB"""
+    return measure(func, *args)[1]
+
+
+def check_streaming_memory(small_bytes=10 * 2 ** 20, large_bytes=2 ** 30,
+                           tolerance=1.5, directory='.'):
+    """Memory regression check for the streaming reader: auditing a large
+    synthetic file (1 GB by default) must not take noticeably more peak
+    memory than auditing a small one"""
+    small = write_synthetic_osm(os.path.join(directory, 'synthetic_small.osm'), small_bytes)
+    large = write_synthetic_osm(os.path.join(directory, 'synthetic_large.osm'), large_bytes)
+    try:
+        small_rss = peak_rss(auditors.run_audits, small)
+        large_rss = peak_rss(auditors.run_audits, large)
+    finally:
+        os.remove(small)
+        os.remove(large)
+    print "Peak RSS auditing %d MB: %d kB" % (small_bytes // 2 ** 20, small_rss)
+    print "Peak RSS auditing %d MB: %d kB" % (large_bytes // 2 ** 20, large_rss)
+    assert large_rss <= small_rss * tolerance, "peak memory grows with file size"
+    return small_rss, large_rss
+
+
+# Sizes of the memory check run with every benchmark. Reading the whole
+# tree of the larger file would take about ten times the memory
+QUICK_MEMORY_BYTES = (2 * 2 ** 20, 20 * 2 ** 20)
+
+
+def check_streaming_memory_quick():
+    """check_streaming_memory on files small enough to run every time, in a
+    temporary directory"""
+    with temp_directory():
+        return check_streaming_memory(*QUICK_MEMORY_BYTES)
+
+
+# Benchmark suite: every step of the pipeline on synthetic files of several
+# sizes, each step in a fresh process so that its peak memory is its own.
+# Results are saved as JSON and compared against an earlier run to catch
+# regressions
+
+SUITE_SIZES_MB = (10, 100)
+REGRESSION_TOLERANCE = 0.25
+
+
+def suite_audit(osmfile):
+    auditors.run_audits(osmfile)
+
+
+def suite_convert(osmfile, directory):
+    """data.process_map without validation, to csv files in directory.
+    Return the seconds per stage"""
+    paths = [os.path.join(directory, os.path.basename(path)) for path in data.CSV_PATHS]
+    stats = instrument.RunStats()
+    data.shape_to_csv(data.get_element(osmfile, tags=data.ELEMENT_TAGS), paths, False,
+                      stats=stats)
+    stats.stop('write')
+    for path in paths:
+        os.remove(path)
+    return dict(stats.times)
+
+
+def suite_load(osmfile, sqlite_file):
+    return sum(osmdb.load_osm(osmfile, sqlite_file).values())
+
+
+def suite_reports(sqlite_file, repeat=5):
+    """Best time of a round of the sqlqueries.py reports, without the cache"""
+    db = queries.OSMQueries(sqlite_file, cache_size=0)
+    try:
+        return best_time(lambda: [call() for _, call in report_calls(db)], repeat=repeat)
+    finally:
+        db.close()
+
+
+def synthetic_file(directory, size_mb, seed=0):
+    """Path and element counts of the synthetic file of size_mb MB, written
+    if not there yet. The same seed gives the same file, so it is kept for
+    later runs"""
+    path = os.path.join(directory, 'synthetic_%dmb_%d.osm' % (size_mb, seed))
+    counts_path = path + '.counts'
+    if os.path.exists(path) and os.path.exists(counts_path):
+        with open(counts_path, 'rb') as f:
+            return path, json.load(f)
+    counts = synthetic.write_osm(path, size_mb * 2 ** 20, seed)
+    with open(counts_path, 'wb') as f:
+        json.dump(counts, f)
+    return path, counts
+
+
+def run_suite(sizes_mb=SUITE_SIZES_MB, directory='.', seed=0):
+    """Run the auditors, the csv conversion, the database load and the
+    sqlqueries.py reports on a synthetic file of each size. Return the
+    wall time, throughput and peak RSS of each step by size"""
+    results = {'python': sys.version.split()[0], 'platform': sys.platform, 'seed': seed,
+               'cpus': multiprocessing.cpu_count(), 'sizes': {}}
+    for size_mb in sizes_mb:
+        osmfile, counts = synthetic_file(directory, size_mb, seed)
+        elements = counts['nodes'] + counts['ways'] + counts['relations']
+        megabytes = counts['bytes'] / float(2 ** 20)
+        sqlite_file = os.path.join(directory, 'bench_suite.db')
+        steps = {}
+        try:
+            for step, func, args in [('audit', suite_audit, (osmfile,)),
+                                     ('convert', suite_convert, (osmfile, directory)),
+                                     ('load', suite_load, (osmfile, sqlite_file)),
+                                     ('reports', suite_reports, (sqlite_file,))]:
+                seconds, rss, result = measure(func, *args)
+                if step == 'reports':
+                    # Time of one round, not of opening the database
+                    seconds = result
+                steps[step] = {'seconds': round(seconds, 4), 'peak_rss_kb': rss}
+                line = "%5d MB %-8s %8.3f s %8d kB" % (size_mb, step, seconds, rss)
+                if step != 'reports':
+                    steps[step]['mb_per_second'] = round(megabytes / seconds, 2)
+                    steps[step]['elements_per_second'] = int(elements / seconds)
+                    line += " %7.2f MB/s %8d elements/s" % (megabytes / seconds,
+                                                            elements / seconds)
+                if step == 'convert':
+                    steps[step]['stages'] = dict((stage, round(spent, 4))
+                                                 for stage, spent in result.iteritems())
+                print line
+        finally:
+            if os.path.exists(sqlite_file):
+                os.remove(sqlite_file)
+        results['sizes'][str(size_mb)] = {'file': counts, 'steps': steps}
+    return results
+
+
+def compare_suite(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Steps of results more than tolerance slower, or using more than
+    tolerance more memory, than in baseline, as messages"""
+    regressions = []
+    for size, result in sorted(results['sizes'].iteritems()):
+        before = baseline['sizes'].get(size)
+        if before is None:
+            continue
+        for step, now in sorted(result['steps'].iteritems()):
+            then = before['steps'].get(step)
+            if then is None:
+                continue
+            for measure_name in ('seconds', 'peak_rss_kb'):
+                if now[measure_name] > then[measure_name] * (1 + tolerance):
+                    regressions.append("%s MB %s: %s %s, was %s" % (
+                        size, step, measure_name, now[measure_name], then[measure_name]))
+    return regressions
+
+
+def suite_main(argv):
+    """python benchmark.py --suite [--sizes=10,100,1000] [--directory=.]
+    [--save=results.json] [--baseline=results.json] [--seed=0]
+    Exit with status 1 if a step regressed against the baseline"""
+    options = dict(arg[2:].split('=', 1) for arg in argv if arg.startswith('--') and '=' in arg)
+    sizes = [int(size) for size in options.get('sizes', ','.join(map(str, SUITE_SIZES_MB)))
+             .split(',')]
+    results = run_suite(sizes, options.get('directory', '.'), int(options.get('seed', 0)))
+    if 'save' in options:
+        with open(options['save'], 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if 'baseline' in options:
+        with open(options['baseline'], 'rb') as f:
+            regressions = compare_suite(results, json.load(f))
+        for regression in regressions:
+            print "REGRESSION", regression
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    if '--suite' in sys.argv:
+        sys.exit(suite_main(sys.argv[1:]))
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    osmfile = args[0] if args else SAMPLE_FILE
+    check_streaming_memory_quick()
+    benchmark_audits(osmfile)
+    benchmark_cleaners(osmfile)
+    benchmark_backends(osmfile)
+    benchmark_compressed_input(osmfile)
+    benchmark_records(osmfile)
+    benchmark_validation(osmfile)
+    benchmark_csv_writers(osmfile)
+    benchmark_schema(osmfile)
+    benchmark_tag_summary(osmfile)
+    if columnar.pa is not None:
+        benchmark_columnar(osmfile)
+    benchmark_queries(osmfile)
+    benchmark_spatial(osmfile)
+    benchmark_geometry(osmfile)
+    benchmark_instrumentation(osmfile)
+    benchmark_process_map(osmfile, workers=sorted(set((1, multiprocessing.cpu_count()))))
+    benchmark_pipeline(osmfile)
+    if '--memory' in sys.argv:
+        check_streaming_memory()
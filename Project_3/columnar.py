@@ -0,0 +1,234 @@
+
+# coding: utf-8
+
+'''
+Columnar output for the OSM tables: the node, way and relation tables of
+data.py written as Parquet or Arrow IPC files with typed columns, ids as
+int64, coordinates as float64, timestamps as timestamps, and users, tag
+keys, values and types and member types and roles dictionary encoded.
+This module supplies the table writers, data.process_map does the rest:
+
+    data.process_map('new_delhi.osm', False, format='parquet')
+
+writes nodes_project.parquet and so on in place of the csv files.
+
+The sqlqueries.py reports can then be computed from the few columns they
+need. The files can also be queried in place with DuckDB, e.g.
+
+    SELECT value, COUNT(*) AS count
+    FROM read_parquet(['nodes_tags_project.parquet', 'ways_tags_project.parquet'])
+    WHERE key = 'postcode' GROUP BY value ORDER BY count DESC LIMIT 10
+
+Needs pyarrow (and pandas for the reports)
+
+'''
+
+import csv
+import os
+import sys
+from itertools import islice, izip
+
+import data
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    np = pa = pq = None
+
+ROW_GROUP_SIZE = 500000
+
+SUFFIXES = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# The csv file of data.py that the file of each table stands in for
+TABLE_CSV_PATHS = dict(zip(('nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags',
+                            'relations', 'relations_tags', 'relation_members'), data.CSV_PATHS))
+
+# Column type of each field of the tables
+FIELD_TYPES = {
+    'id': 'int64',
+    'lat': 'float64',
+    'lon': 'float64',
+    'user': 'dictionary',
+    'uid': 'int64',
+    'version': 'string',
+    'changeset': 'int64',
+    'timestamp': 'timestamp',
+    'key': 'dictionary',
+    'value': 'dictionary',
+    'type': 'dictionary',
+    'node_id': 'int64',
+    'position': 'int32',
+    'member_id': 'int64',
+    'member_type': 'dictionary',
+    'role': 'dictionary',
+}
+
+
+def arrow_type(kind):
+    if kind == 'dictionary':
+        return pa.dictionary(pa.int32(), pa.string())
+    if kind == 'timestamp':
+        return pa.timestamp('s')
+    return getattr(pa, kind)()
+
+
+def to_array(values, kind):
+    """An arrow array of the given kind from a list of csv-style values"""
+    if kind in ('int64', 'int32', 'float64'):
+        return pa.array(np.array(values).astype(kind), type=arrow_type(kind))
+    if kind == 'timestamp':
+        # OSM timestamps are ISO 8601 in UTC, e.g. 2016-01-01T00:00:00Z
+        return pa.array(np.array([v.rstrip('Z') for v in values], dtype='datetime64[s]'))
+    strings = pa.array(values, type=pa.string())
+    return strings.dictionary_encode() if kind == 'dictionary' else strings
+
+
+def table_schema(fields):
+    return pa.schema([pa.field(f, arrow_type(FIELD_TYPES[f])) for f in fields])
+
+
+def output_path(csv_path, format='parquet'):
+    """The path of the file written in place of the csv file at csv_path"""
+    return os.path.splitext(csv_path)[0] + SUFFIXES[format]
+
+
+def table_path(directory, table, format='parquet'):
+    return os.path.join(directory, output_path(TABLE_CSV_PATHS[table], format))
+
+
+class TableWriter(object):
+    """Collect the rows of one table column by column and write them out as
+    a row group / record batch every row_group_size rows. Takes rows like a
+    csvout.RowWriter, values being converted to the column types on the way
+    out"""
+
+    def __init__(self, path, fields, format='parquet', row_group_size=ROW_GROUP_SIZE):
+        self.fields = fields
+        self.kinds = [FIELD_TYPES[f] for f in fields]
+        self.schema = table_schema(fields)
+        self.row_group_size = row_group_size
+        self.columns = [[] for _ in fields]
+        self.rows = 0
+        if format == 'parquet':
+            self.writer = pq.ParquetWriter(path, self.schema, coerce_timestamps='ms')
+        elif format == 'arrow':
+            self.writer = pa.RecordBatchFileWriter(path, self.schema)
+        else:
+            raise ValueError("Unknown format %r" % format)
+
+    def writerow(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        self.added(1)
+
+    def writerows(self, rows):
+        rows = iter(rows)
+        while True:
+            # At most up to the next row group, so that a long iterable of
+            # rows is never held all at once
+            batch = list(islice(rows, self.row_group_size - self.rows))
+            if not batch:
+                break
+            for column, values in izip(self.columns, izip(*batch)):
+                column.extend(values)
+            self.added(len(batch))
+
+    def append_csv(self, part):
+        """Add the rows of the headerless csv file object part"""
+        self.writerows(csv.reader(part))
+
+    def added(self, count):
+        self.rows += count
+        if self.rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        arrays = [to_array(values, kind) for values, kind in zip(self.columns, self.kinds)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = [[] for _ in self.fields]
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_writers(csv_paths, fields, format='parquet', row_group_size=ROW_GROUP_SIZE):
+    """A TableWriter per csv path, writing the file of format in its place,
+    for data.open_table_writers"""
+    if pa is None:
+        raise ImportError("Columnar output needs the pyarrow package")
+    writers = []
+    try:
+        for path, table_fields in zip(csv_paths, fields):
+            writers.append(TableWriter(output_path(path, format), table_fields, format,
+                                       row_group_size))
+    except:
+        for writer in writers:
+            writer.writer.close()
+        raise
+    return writers
+
+
+# Reports of sqlqueries.py computed from the columnar files
+
+def read_columns(directory, table, columns, format='parquet'):
+    """A pandas DataFrame of some columns of a table, with dictionary encoded
+    columns as categoricals"""
+    path = table_path(directory, table, format)
+    if format == 'parquet':
+        dictionaries = [c for c in columns if FIELD_TYPES[c] == 'dictionary']
+        return pq.read_table(path, columns=columns, read_dictionary=dictionaries).to_pandas()
+    table = pa.RecordBatchFileReader(pa.memory_map(path)).read_all()
+    return pa.Table.from_arrays([table.column(c) for c in columns], names=columns).to_pandas()
+
+
+def row_count(directory, table, format='parquet'):
+    path = table_path(directory, table, format)
+    if format == 'parquet':
+        return pq.ParquetFile(path).metadata.num_rows
+    reader = pa.RecordBatchFileReader(pa.memory_map(path))
+    return sum(reader.get_batch(i).num_rows for i in xrange(reader.num_record_batches))
+
+
+def user_counts(directory, format='parquet'):
+    """Number of nodes and ways per user, most active first"""
+    counts = None
+    for table in ('nodes', 'ways'):
+        table_counts = read_columns(directory, table, ['user'], format)['user'].value_counts()
+        counts = table_counts if counts is None else counts.add(table_counts, fill_value=0)
+    return counts[counts > 0].astype(int).sort_values(ascending=False)
+
+
+def number_of_unique_users(directory, format='parquet'):
+    uids = [read_columns(directory, table, ['uid'], format)['uid'] for table in ('nodes', 'ways')]
+    return len(np.union1d(uids[0].values, uids[1].values))
+
+
+def top_contributing_users(directory, limit=10, format='parquet'):
+    return list(user_counts(directory, format)[:limit].iteritems())
+
+
+def number_of_users_contributing_once(directory, format='parquet'):
+    return int((user_counts(directory, format) == 1).sum())
+
+
+def top_tag_values(directory, key, limit=None, format='parquet'):
+    """(value, count) of the node and way tags with key, most common first
+    and in reverse value order among equal counts, like the sqlite reports"""
+    counts = None
+    for table in ('nodes_tags', 'ways_tags'):
+        tags = read_columns(directory, table, ['key', 'value'], format)
+        table_counts = tags['value'][tags['key'] == key].value_counts()
+        counts = table_counts if counts is None else counts.add(table_counts, fill_value=0)
+    counts = counts[counts > 0].astype(int)
+    return sorted(counts.iteritems(), key=lambda item: (item[1], item[0]), reverse=True)[:limit]
+
+
+if __name__ == '__main__':
+    data.process_map(sys.argv[1] if len(sys.argv) > 1 else data.OSM_PATH, False,
+                     format=sys.argv[2] if len(sys.argv) > 2 else 'parquet')
@@ -0,0 +1,126 @@
+
+# coding: utf-8
+
+'''
+Buffered csv output for data.py. Rows are field-ordered tuples formatted by
+csv.writer into an in-memory buffer that is written out in large blocks,
+optionally through gzip or zstd compression
+
+'''
+
+import csv
+import cStringIO
+import gzip
+import shutil
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFER_SIZE = 2 ** 20
+
+# Fast compression levels: the point is to save disk and I/O, not to get the
+# smallest files
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+
+SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def output_path(path, compression=None):
+    """path with the file extension of the compression"""
+    return path + SUFFIXES[compression]
+
+
+def utf8_row(row):
+    """Encode the unicode values of a row to utf-8, leave the others as they are"""
+    return [value.encode('utf-8') if isinstance(value, unicode) else value for value in row]
+
+
+class ZstdPipe(object):
+    """Write to a zstd compressed file through the zstd command, when the
+    zstandard package is not installed"""
+
+    def __init__(self, path, level=ZSTD_LEVEL):
+        self.process = subprocess.Popen(['zstd', '-q', '-f', '-%d' % level, '-o', path],
+                                        stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise IOError("zstd exited with status %d" % self.process.returncode)
+
+
+def open_output(path, compression=None):
+    """Open path for writing bytes, compressed with 'gzip' or 'zstd' if given.
+    The file extension is not added here, see output_path"""
+    if compression is None:
+        return open(path, 'wb')
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', GZIP_LEVEL)
+    if compression == 'zstd':
+        if zstandard is None:
+            return ZstdPipe(path)
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, 'wb'))
+    raise ValueError("Unknown compression %r" % compression)
+
+
+class RowWriter(object):
+    """Write rows of byte strings and numbers to a file object, buffering
+    BUFFER_SIZE bytes of formatted csv between writes. Rows holding unicode
+    must go through utf8_row first"""
+
+    def __init__(self, output, buffer_size=BUFFER_SIZE):
+        self.output = output
+        self.buffer_size = buffer_size
+        self.buffer = cStringIO.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.output.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def append_csv(self, part):
+        """Copy the rows of the headerless csv file object part to the output"""
+        self.flush()
+        shutil.copyfileobj(part, self.output, self.buffer_size)
+
+    def close(self):
+        self.flush()
+        self.output.close()
+
+
+def open_writers(paths, header_fields=None, compression=None):
+    """A RowWriter per path, with a header row of the matching header_fields"""
+    writers = []
+    try:
+        for i, path in enumerate(paths):
+            writers.append(RowWriter(open_output(output_path(path, compression), compression)))
+            if header_fields:
+                writers[-1].writerow(header_fields[i])
+    except:
+        for writer in writers:
+            writer.output.close()
+        raise
+    return writers
+
+
+def close_writers(writers):
+    for writer in writers:
+        writer.close()
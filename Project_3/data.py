@@ -160,14 +160,26 @@ The final return value for a "way" element should look something like:
                'value': '366409'}]}
 """
 
-import csv
-import codecs
 import re
 import os
+import json
 import pprint
-import xml.etree.cElementTree as ET
-import cerberus
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import threading
+from array import array
+from itertools import count, islice, izip, repeat
+from Queue import Queue
 import schema
+import schemacheck
+import csvout
+import geometry
+import instrument
+import osmstream
+from lrucache import lru_cache
+from records import NodeRecord, WayRecord, RelationRecord
 
 OSM_FILE = 'new_delhi.osm'
 
@@ -178,11 +190,54 @@ NODE_TAGS_PATH = "nodes_tags_project.csv"
 WAYS_PATH = "ways_project.csv"
 WAY_NODES_PATH = "ways_nodes_project.csv"
 WAY_TAGS_PATH = "ways_tags_project.csv"
+RELATIONS_PATH = "relations_project.csv"
+RELATION_TAGS_PATH = "relations_tags_project.csv"
+RELATION_MEMBERS_PATH = "relation_members_project.csv"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
-SCHEMA = schema.schema
+# schema.py only covers nodes and ways
+RELATION_SCHEMA = {
+    'relation': {
+        'type': 'dict',
+        'schema': {
+            'id': {'required': True, 'type': 'integer', 'coerce': int},
+            'user': {'required': True, 'type': 'string'},
+            'uid': {'required': True, 'type': 'integer', 'coerce': int},
+            'version': {'required': True, 'type': 'string'},
+            'changeset': {'required': True, 'type': 'integer', 'coerce': int},
+            'timestamp': {'required': True, 'type': 'string'}
+        }
+    },
+    'relation_members': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'member_id': {'required': True, 'type': 'integer', 'coerce': int},
+                'member_type': {'required': True, 'type': 'string'},
+                'role': {'required': True, 'type': 'string'},
+                'position': {'required': True, 'type': 'integer', 'coerce': int}
+            }
+        }
+    },
+    'relation_tags': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'key': {'required': True, 'type': 'string'},
+                'value': {'required': True, 'type': 'string'},
+                'type': {'required': True, 'type': 'string'}
+            }
+        }
+    }
+}
+
+SCHEMA = dict(schema.schema, **RELATION_SCHEMA)
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
@@ -190,11 +245,22 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'member_type', 'role', 'position']
 
-# Relevant functions for cleaning 'addr:street'
+CSV_PATHS = (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH,
+             RELATIONS_PATH, RELATION_TAGS_PATH, RELATION_MEMBERS_PATH)
+CSV_FIELDS = (NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS,
+              RELATION_FIELDS, RELATION_TAGS_FIELDS, RELATION_MEMBERS_FIELDS)
 
-def is_street_name(elem):
-    return (elem.attrib['k'] == "addr:street")
+ELEMENT_TAGS = ('node', 'way', 'relation')
+
+# Output formats of process_map: csv files, or the same tables as Parquet or
+# Arrow IPC files, see columnar
+OUTPUT_FORMATS = ('csv', 'parquet', 'arrow')
+
+# Relevant functions for cleaning 'addr:street'
 
 
 
@@ -235,9 +301,6 @@ def update_street_name(name, mapping):
 
 #Relevant functions for cleaning 'addr:postcode'
 
-def is_post_code(elem):
-    return (elem.attrib['k'] == "addr:postcode")
-
 #Clean valid postcodes only
 mapping2 = {
     '110 001':'110001',
@@ -255,9 +318,6 @@ def update_postcode(postcode, mapping):
 
 # Relevant code for cleaning 'addr:city'
 
-def is_city(elem):
-    return (elem.attrib['k'] == "addr:city")
-
 #Clean valid city name
 
 mapping3 = {
@@ -277,88 +337,125 @@ def update_city(city, mapping):
 
 
 
+# Cleaners applied to the value of tags by full key. A cleaner returns the
+# cleaned value, or None if the tag should be dropped. The same values repeat
+# heavily, so results are kept in a bounded LRU cache per cleaner
+
+CLEANER_CACHE_SIZE = 50000
+
+@lru_cache(CLEANER_CACHE_SIZE)
+def clean_street(street):
+    return update_street_name(street, mapping)
+
+@lru_cache(CLEANER_CACHE_SIZE)
+def clean_postcode(postcode):
+    if not postcode.startswith('11'):
+        return None
+    return update_postcode(postcode, mapping2)
+
+@lru_cache(CLEANER_CACHE_SIZE)
+def clean_city(city):
+    if city == 'noida':
+        return None
+    return update_city(city, mapping3)
+
+TAG_CLEANERS = {
+    'addr:street': clean_street,
+    'addr:postcode': clean_postcode,
+    'addr:city': clean_city,
+}
+
+def cleaner_cache_info():
+    """Hits, misses and size of the cache of each tag cleaner"""
+    return dict((k, cleaner.info()) for k, cleaner in TAG_CLEANERS.iteritems())
+
+
+class KeyClassifier(object):
+    """Decide once per distinct tag key how tags with that key are shaped.
+
+    classify(k) returns None if the key contains problem characters and the
+    tag is to be ignored, otherwise a (key, type, cleaner) tuple where cleaner
+    is None for values that are kept as they are. OSM files only use a few
+    thousand distinct keys, so decisions are cached per key instead of being
+    worked out again for every tag.
+    """
+
+    def __init__(self, problem_chars=PROBLEMCHARS, default_tag_type='regular',
+                 cleaners=TAG_CLEANERS, max_keys=100000):
+        self.problem_chars = problem_chars
+        self.default_tag_type = default_tag_type
+        self.cleaners = cleaners
+        self.max_keys = max_keys
+        self.decisions = {}
+
+    def classify(self, k):
+        try:
+            return self.decisions[k]
+        except KeyError:
+            pass
+
+        if self.problem_chars.search(k) is not None:
+            decision = None
+        elif LOWER_COLON.search(k) is None:
+            decision = (k, self.default_tag_type, None)
+        else:
+            tag_type, key = k.split(":", 1)
+            decision = (key, tag_type, self.cleaners.get(k))
+
+        if len(self.decisions) < self.max_keys:
+            self.decisions[k] = decision
+        return decision
+
+
+_classifiers = {}
+
+def key_classifier(problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Return the shared KeyClassifier for these settings"""
+    try:
+        return _classifiers[(problem_chars, default_tag_type)]
+    except KeyError:
+        classifier = _classifiers[(problem_chars, default_tag_type)] = \
+            KeyClassifier(problem_chars, default_tag_type)
+        return classifier
+
+
+def shape_tags(element, classifier):
+    """Shape the secondary tags of a node or way element"""
+    tags = []
+    element_id = element.attrib['id']
+    for tag in element.iter("tag"):
+        decision = classifier.classify(tag.attrib['k'])
+        if decision is None:
+            continue
+        key, tag_type, cleaner = decision
+        value = tag.attrib['v']
+        if cleaner is not None:
+            value = cleaner(value)
+            if value is None:
+                continue
+        tags.append({'id': element_id, 'key': key, 'value': value, 'type': tag_type})
+    return tags
+
+
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular',
+                  relation_attr_fields=RELATION_FIELDS, classifier=None):
+    """Clean and shape node, way or relation XML element to Python dict"""
 
     node_attribs = {}
     way_attribs = {}
     way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
+    classifier = classifier or key_classifier(problem_chars, default_tag_type)
 
-    # YOUR CODE HERE
     if element.tag == 'node':
         for item in node_attr_fields:
             node_attribs[item] = element.attrib[item]
-        for tag in element.iter("tag"):
-            nodes_tag = {} 
-            nodes_tag['id'] = element.attrib['id']
-            
-            if re.search(problem_chars,tag.attrib['k']) is not None:
-                continue
-            else:
-                m = LOWER_COLON.search(tag.attrib['k'])#We try to find out if the key is made with " : " format or only word.
-                if m is None:
-                    nodes_tag['key'] = tag.attrib['k']
-                    nodes_tag['type'] = 'regular'
-                    nodes_tag['value'] = tag.attrib['v']
-                else:
-                    
-                    if is_street_name(tag):
-                        nodes_tag['value'] = update_street_name(tag.attrib['v'], mapping)
-                    elif is_post_code(tag):
-                        if not tag.attrib['v'].startswith('11'):
-                            continue
-                        else:
-                            nodes_tag['value'] = update_postcode(tag.attrib['v'], mapping2)
-                    elif is_city(tag):
-                        if tag.attrib['v'] == 'noida':
-                            continue
-                        else:
-                            nodes_tag['value'] = update_city(tag.attrib['v'], mapping3)
-                    else:
-                        nodes_tag['value'] = tag.attrib['v']
-                    
-                    nodes_tag['key'] = tag.attrib['k'].split(":",1)[1]
-                    nodes_tag['type'] = tag.attrib['k'].split(":",1)[0]
-                        
-            
-            tags.append(nodes_tag)
+        tags = shape_tags(element, classifier)
         return {'node': node_attribs, 'node_tags': tags}
     elif element.tag == 'way':
         for item in way_attr_fields:
             way_attribs[item] = element.attrib[item]
-        for tag in element.iter("tag"):
-            ways_tag = {}
-            ways_tag['id'] = element.attrib['id']
-            if re.search(problem_chars,tag.attrib['k']) is not None:
-                continue
-            else:
-                m = LOWER_COLON.search(tag.attrib['k'])#We try to find out if the key is made with " : " format or only word.
-                if m is None:
-                    ways_tag['key'] = tag.attrib['k']
-                    ways_tag['type'] = 'regular'
-                    ways_tag['value'] = tag.attrib['v']
-                else:
-                    if is_street_name(tag):
-                        ways_tag['value'] = update_street_name(tag.attrib['v'], mapping)
-                    elif is_post_code(tag):
-                        if not tag.attrib['v'].startswith('11'):
-                            continue
-                        else:
-                            ways_tag['value'] = update_postcode(tag.attrib['v'], mapping2)
-                    elif is_city(tag):
-                        if tag.attrib['v'] == 'noida':
-                            continue
-                        else:
-                            ways_tag['value'] = update_city(tag.attrib['v'], mapping3)
-                        
-                    else:
-                        ways_tag['value'] = tag.attrib['v']
-                    
-                    ways_tag['key'] = tag.attrib['k'].split(":",1)[1]
-                    ways_tag['type'] = tag.attrib['k'].split(":",1)[0]
-            tags.append(ways_tag)
+        tags = shape_tags(element, classifier)
         i = 0
         for tag in element.iter("nd"):
             way_nodes_tag = {}
@@ -370,20 +467,128 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
             
             
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    elif element.tag == 'relation':
+        relation_attribs = {}
+        for item in relation_attr_fields:
+            relation_attribs[item] = element.attrib[item]
+        tags = shape_tags(element, classifier)
+        members = []
+        for i, member in enumerate(element.iter("member")):
+            members.append({'id': element.attrib['id'],
+                            'member_id': member.attrib['ref'],
+                            'member_type': member.attrib['type'],
+                            'role': member.attrib.get('role', ''),
+                            'position': i})
+        return {'relation': relation_attribs, 'relation_members': members,
+                'relation_tags': tags}
+
+
+# ================================================== #
+#               Compact Records                      #
+# ================================================== #
+# Shaped elements for the csv output when no validation is needed, as the
+# NodeRecord, WayRecord and RelationRecord objects of records.py
+
+# array('l') holds 64 bit integers on most platforms, enough for OSM ids
+NODE_REF_TYPECODE = 'l' if array('l').itemsize >= 8 else None
+
+
+def utf8(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def record_tags(element, classifier):
+    """Shape the secondary tags of an element to tuples"""
+    tags = []
+    for tag in element.iter("tag"):
+        decision = classifier.classify(tag.attrib['k'])
+        if decision is None:
+            continue
+        key, tag_type, cleaner = decision
+        value = tag.attrib['v']
+        if cleaner is not None:
+            value = cleaner(value)
+            if value is None:
+                continue
+        tags.append((utf8(key), utf8(value), utf8(tag_type)))
+    return tags
+
+
+def shape_record(element, classifier=None):
+    """Clean and shape a node, way or relation XML element to a NodeRecord,
+    WayRecord or RelationRecord, with the same content as shape_element.
+    Relation members are (member_id, member_type, role) tuples"""
+    classifier = classifier or key_classifier()
+    attrib = element.attrib
+    if element.tag == 'node':
+        return NodeRecord(attrib['id'], tuple(utf8(attrib[f]) for f in NODE_FIELDS),
+                          record_tags(element, classifier))
+    elif element.tag == 'way':
+        refs = [nd.attrib['ref'] for nd in element.iter("nd")]
+        if NODE_REF_TYPECODE:
+            refs = array(NODE_REF_TYPECODE, map(int, refs))
+        return WayRecord(attrib['id'], tuple(utf8(attrib[f]) for f in WAY_FIELDS),
+                         record_tags(element, classifier), refs)
+    elif element.tag == 'relation':
+        members = [(m.attrib['ref'], m.attrib['type'], utf8(m.attrib.get('role', '')))
+                   for m in element.iter("member")]
+        return RelationRecord(attrib['id'], tuple(utf8(attrib[f]) for f in RELATION_FIELDS),
+                              record_tags(element, classifier), members)
+
+
+def open_table_writers(csv_paths, format='csv', header=True, compression=None):
+    """A writer per table for the eight csv files in csv_paths: csvout
+    RowWriters, or with format 'parquet' or 'arrow' columnar TableWriters,
+    writing a file of that format in place of each csv file"""
+    if format == 'csv':
+        return csvout.open_writers(csv_paths, CSV_FIELDS if header else None, compression)
+    if compression:
+        raise ValueError("%s files are compressed by the format itself, "
+                         "leave out compression" % format)
+    # Imported here as columnar imports data, and needs pyarrow
+    import columnar
+    return columnar.open_writers(csv_paths, CSV_FIELDS, format)
+
+
+def records_to_csv(records, csv_paths, header=True, compression=None, format='csv'):
+    """Write NodeRecords, WayRecords and RelationRecords to the eight csv
+    files in csv_paths"""
+
+    writers = open_table_writers(csv_paths, format, header, compression)
+    try:
+        write_records(records, writers)
+    finally:
+        csvout.close_writers(writers)
+
+
+def write_records(records, writers):
+    """Write records to the eight csv writers, in the order of CSV_PATHS"""
+    (nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer,
+     relations_writer, relation_tags_writer, relation_members_writer) = writers
+    for record in records:
+        if record is None:
+            continue
+        element_id = (record.id,)
+        if record.__class__ is NodeRecord:
+            nodes_writer.writerow(record.values)
+            node_tags_writer.writerows([element_id + tag for tag in record.tags])
+        elif record.__class__ is WayRecord:
+            ways_writer.writerow(record.values)
+            way_nodes_writer.writerows(izip(repeat(record.id), record.node_refs, count()))
+            way_tags_writer.writerows([element_id + tag for tag in record.tags])
+        else:
+            relations_writer.writerow(record.values)
+            relation_members_writer.writerows([element_id + member + (i,)
+                                               for i, member in enumerate(record.members)])
+            relation_tags_writer.writerows([element_id + tag for tag in record.tags])
 
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=None):
     """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return osmstream.iter_elements(osm_file, tags, backend)
 
 
 def validate_element(element, validator, schema=SCHEMA):
@@ -396,64 +601,720 @@ def validate_element(element, validator, schema=SCHEMA):
         raise Exception(message_string.format(field, error_string))
 
 
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
-
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
-
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+def field_row(row, fields):
+    """The values of a shaped row dict in field order, utf-8 encoded"""
+    return csvout.utf8_row([row[field] for field in fields])
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file,          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file,          codecs.open(WAYS_PATH, 'w') as ways_file,          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file,          codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
-
-
+def record_element(record):
+    """The shape_element form of a NodeRecord, WayRecord or RelationRecord"""
+    element_id = (record.id,)
+    if record.__class__ is NodeRecord:
+        return {'node': dict(izip(NODE_FIELDS, record.values)),
+                'node_tags': [dict(izip(NODE_TAGS_FIELDS, element_id + tag)) for tag in record.tags]}
+    if record.__class__ is RelationRecord:
+        return {'relation': dict(izip(RELATION_FIELDS, record.values)),
+                'relation_members': [dict(izip(RELATION_MEMBERS_FIELDS, element_id + member + (i,)))
+                                     for i, member in enumerate(record.members)],
+                'relation_tags': [dict(izip(RELATION_TAGS_FIELDS, element_id + tag))
+                                  for tag in record.tags]}
+    return {'way': dict(izip(WAY_FIELDS, record.values)),
+            'way_nodes': [dict(izip(WAY_NODES_FIELDS, (record.id, str(ref), i)))
+                          for i, ref in enumerate(record.node_refs)],
+            'way_tags': [dict(izip(WAY_TAGS_FIELDS, element_id + tag)) for tag in record.tags]}
+
+
+def validate_records(records, validate_every, validator=None):
+    """Pass records through, validating every validate_every-th one"""
+    validator = validator or schemacheck.CompiledValidator(SCHEMA)
+    for i, record in enumerate(records):
+        if record is not None and i % validate_every == 0:
+            validate_element(record_element(record), validator)
+        yield record
+
+
+def shape_each(elements, classifier=None):
+    """Yield (tag, shaped element) pairs for elements"""
+    return ((element.tag, shape_element(element, classifier=classifier)) for element in elements)
+
+
+def validate_shaped(shaped, validate_every=1, validator=None):
+    """Pass (tag, shaped element) pairs through, validating every
+    validate_every-th element"""
+    validator = validator or schemacheck.CompiledValidator(SCHEMA)
+    for i, (tag, el) in enumerate(shaped):
+        if el and i % validate_every == 0:
+            validate_element(el, validator)
+        yield tag, el
+
+
+def shaped_elements(elements, validate, validate_every=1, validator=None):
+    """Yield (tag, shaped element) pairs for elements, validated if asked.
+    validate_every=N only validates one element in N, and validator
+    defaults to one compiled from SCHEMA, which is much faster than
+    cerberus.Validator"""
+
+    shaped = shape_each(elements)
+    if validate is True:
+        shaped = validate_shaped(shaped, validate_every, validator)
+    return shaped
+
+
+def timed(stats, stage, iterable):
+    """iterable, timed as stage if stats (an instrument.RunStats) is given"""
+    return iterable if stats is None else stats.timed(stage, iterable)
+
+
+def shaped_to_csv(shaped, csv_paths, header=True, compression=None, geometry_writer=None,
+                  format='csv'):
+    """Write (tag, shaped element) pairs to the eight csv files in csv_paths"""
+
+    writers = open_table_writers(csv_paths, format, header, compression)
+    try:
+        write_shaped(shaped, writers, geometry_writer)
+    finally:
+        csvout.close_writers(writers)
+
+
+def write_shaped(shaped, writers, geometry_writer=None):
+    """Write (tag, shaped element) pairs to the eight csv writers, in the
+    order of CSV_PATHS"""
+    (nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer,
+     relations_writer, relation_tags_writer, relation_members_writer) = writers
+    for tag, el in shaped:
+        if el:
+            if tag == 'node':
+                nodes_writer.writerow(field_row(el['node'], NODE_FIELDS))
+                node_tags_writer.writerows([field_row(t, NODE_TAGS_FIELDS)
+                                            for t in el['node_tags']])
+                if geometry_writer is not None:
+                    node = el['node']
+                    geometry_writer.add_node(node['id'], node['lat'], node['lon'])
+            elif tag == 'way':
+                ways_writer.writerow(field_row(el['way'], WAY_FIELDS))
+                way_nodes_writer.writerows([field_row(n, WAY_NODES_FIELDS)
+                                            for n in el['way_nodes']])
+                way_tags_writer.writerows([field_row(t, WAY_TAGS_FIELDS)
+                                           for t in el['way_tags']])
+                if geometry_writer is not None:
+                    geometry_writer.add_way(el['way']['id'],
+                                            [n['node_id'] for n in el['way_nodes']])
+            elif tag == 'relation':
+                relations_writer.writerow(field_row(el['relation'], RELATION_FIELDS))
+                relation_members_writer.writerows([field_row(m, RELATION_MEMBERS_FIELDS)
+                                                   for m in el['relation_members']])
+                relation_tags_writer.writerows([field_row(t, RELATION_TAGS_FIELDS)
+                                                for t in el['relation_tags']])
+
+
+def shape_to_csv(elements, csv_paths, validate, header=True, compact=True,
+                 validate_every=1, compression=None, geometry_path=None, stats=None,
+                 format='csv'):
+    """Shape each XML element and write it to the eight csv files in csv_paths,
+    given in the order nodes, node tags, ways, way nodes, way tags,
+    relations, relation tags, relation members.
+    Without validation, or with validation of one element in
+    validate_every > 1, elements are shaped to compact records.
+    compression ('gzip' or 'zstd') compresses the files and adds the matching
+    extension to their paths. format 'parquet' or 'arrow' writes columnar
+    files in place of the csv files, see columnar. With a geometry_path the
+    coordinates, length and bounding box of every way are written there
+    too, see geometry. stats, an instrument.RunStats, collects the time of
+    each stage and the element and tag counts"""
+
+    classifier = key_classifier()
+    if stats is not None:
+        elements = stats.timed('parse', elements)
+        classifier = instrument.CountingClassifier(classifier, stats)
+    compact = compact and compact_output(validate, validate_every)
+    geometry_writer = None
+    if geometry_path:
+        geometry_writer = geometry.GeometryWriter(geometry_path, header, compression)
+    try:
+        shaped = shaping_stages(elements, validate, compact, validate_every, classifier,
+                                geometry_writer, stats)
+        if compact:
+            records_to_csv(shaped, csv_paths, header, compression, format)
+        else:
+            shaped_to_csv(shaped, csv_paths, header, compression, geometry_writer, format)
+    finally:
+        if geometry_writer is not None:
+            geometry_writer.close()
+
+
+def compact_output(validate, validate_every=1):
+    """Whether elements can be shaped to compact records: the dicts of
+    shape_element are needed to validate every element"""
+    return not validate or validate_every > 1
+
+
+def shaping_stages(elements, validate, compact, validate_every=1, classifier=None,
+                   geometry_writer=None, stats=None, validator=None):
+    """The generator pipeline from XML elements to compact records, or to
+    (tag, shaped element) pairs if not compact, as written by write_records
+    and write_shaped. Compact records are added to the way geometry here,
+    shaped elements by write_shaped"""
+    classifier = classifier or key_classifier()
+    if compact:
+        records = timed(stats, 'shape', (shape_record(element, classifier)
+                                         for element in elements))
+        if validate:
+            records = timed(stats, 'validate',
+                            validate_records(records, validate_every, validator))
+        if geometry_writer is not None:
+            records = timed(stats, 'geometry', geometry.track_records(records, geometry_writer))
+        if stats is not None:
+            records = stats.timed('count', instrument.count_records(records, stats))
+        return records
+    shaped = timed(stats, 'shape', shape_each(elements, classifier))
+    if validate is True:
+        shaped = timed(stats, 'validate', validate_shaped(shaped, validate_every, validator))
+    if stats is not None:
+        shaped = stats.timed('count', instrument.count_shaped(shaped, stats))
+    return shaped
+
+
+def process_map(file_in, validate, workers=1, backend=None, validate_every=1,
+                compression=None, geometry_path=None, report_path=None, profile_path=None,
+                checkpoint_path=None, resume=False, threads=0, format='csv'):
+    """Iteratively process each XML element and write to csv(s).
+    file_in may be compressed, e.g. new_delhi.osm.bz2, see osmstream.open_osm,
+    but must be uncompressed to be split into shards or checkpointed.
+    With workers > 1 the file is split into shards converted in parallel.
+    backend selects the XML parser, see osmstream.BACKENDS.
+    With validate_every=N only one element in N is validated.
+    compression writes e.g. nodes_project.csv.gz with 'gzip', see csvout.
+    geometry_path (e.g. geometry.WAY_GEOMETRY_PATH) adds the way geometry
+    csv, which needs a single pass over the whole file.
+    report_path writes a JSON report of the time taken by each stage, the
+    elements and tags processed and the peak memory use, see instrument.
+    profile_path dumps cProfile stats of the run (of this process only when
+    workers > 1).
+    checkpoint_path (e.g. CHECKPOINT_PATH) records progress as the file is
+    converted, and with resume=True a run killed partway through carries on
+    from its last checkpoint instead of starting over.
+    With threads=N (>= 1) parsing, shaping by N threads and writing run as
+    a pipeline of threads, see ConversionPipeline.
+    format 'parquet' or 'arrow' writes the tables as columnar files, e.g.
+    nodes_project.parquet, instead of csv files, see columnar"""
+
+    if format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown format %r, use one of %s" % (format, ', '.join(OUTPUT_FORMATS)))
+    if workers > 1 and geometry_path:
+        raise ValueError("Way geometry needs all the nodes before the ways, use workers=1")
+    if checkpoint_path and (workers > 1 or compression or geometry_path or format != 'csv'):
+        raise ValueError("Checkpoints need workers=1 and uncompressed csv output without "
+                         "way geometry")
+    if threads and (workers > 1 or checkpoint_path or geometry_path):
+        raise ValueError("The thread pipeline needs workers=1, no checkpoint and no way geometry")
+    stats = instrument.RunStats() if report_path else None
+    with instrument.profiled(profile_path):
+        if checkpoint_path:
+            process_map_checkpointed(file_in, validate, checkpoint_path, resume, backend,
+                                     validate_every, stats)
+        elif workers > 1:
+            process_map_parallel(file_in, validate, workers, backend, validate_every,
+                                 compression, stats, format)
+        elif threads:
+            process_map_pipelined(file_in, validate, threads, backend, validate_every,
+                                  compression, stats, format)
+        else:
+            shape_to_csv(get_element(file_in, tags=ELEMENT_TAGS, backend=backend), CSV_PATHS,
+                         validate, validate_every=validate_every, compression=compression,
+                         geometry_path=geometry_path, stats=stats, format=format)
+    if stats is not None:
+        # Worker and thread stages are added up, the main process splits
+        # the file, waits for the workers and merges their output
+        stats.stop('write' if workers <= 1 and not threads else 'wait')
+        stats.write_report(report_path, file=file_in, validate=validate,
+                           validate_every=validate_every, workers=workers, threads=threads,
+                           backend=backend, compression=compression,
+                           geometry=bool(geometry_path), profile=profile_path,
+                           checkpoint=checkpoint_path, resume=resume, format=format)
 
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-process_map(OSM_PATH, validate=False)
 
+# ================================================== #
+#               Parallel Conversion                  #
+# ================================================== #
+SHARD_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+SHARDS_PER_WORKER = 4
+
+
+def next_element_offset(osm_file, offset, end, block_size=2 ** 16):
+    """Return the byte offset of the first top level element starting at or
+    after offset, or end if there is none"""
+    osm_file.seek(offset)
+    while offset < end:
+        block = osm_file.read(block_size + 32)
+        if not block:
+            break
+        m = osmstream.TOP_LEVEL_START.search(block)
+        if m and m.start() < block_size:
+            return offset + m.start()
+        offset += block_size
+        osm_file.seek(offset)
+    return end
+
+
+def find_shards(file_in, count):
+    """Split file_in into at most count (start, end) byte ranges, each made of
+    whole top level elements, in file order"""
+    if osmstream.compression(file_in) is not None:
+        raise ValueError("%s is compressed and cannot be split, decompress it first "
+                         "or use workers=1 without a checkpoint" % file_in)
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as osm_file:
+        osm_file.seek(max(0, size - 4096))
+        tail = osm_file.read()
+        end = size - len(tail) + tail.rfind(osmstream.OSM_END) if osmstream.OSM_END in tail else size
+        offsets = []
+        for i in range(count):
+            offset = next_element_offset(osm_file, size * i // count, end)
+            if not offsets or offset > offsets[-1]:
+                offsets.append(offset)
+    if offsets[-1] < end:
+        offsets.append(end)
+    return zip(offsets[:-1], offsets[1:])
+
+
+class ShardFile(object):
+    """Read-only file object over bytes [start, end) of an OSM file, wrapped
+    in its own <osm> root so that it parses as a complete document"""
+
+    def __init__(self, path, start, end):
+        self.osm_file = open(path, 'rb')
+        self.osm_file.seek(start)
+        self.remaining = end - start
+        self.buffer = SHARD_HEAD
+        self.closed_root = False
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.remaining + len(self.buffer) + len(osmstream.OSM_END)
+        while len(self.buffer) < size and not self.closed_root:
+            if self.remaining > 0:
+                data = self.osm_file.read(min(self.remaining, max(size, 2 ** 16)))
+                self.remaining -= len(data)
+                if not data:
+                    self.remaining = 0
+                self.buffer += data
+            else:
+                self.buffer += osmstream.OSM_END
+                self.closed_root = True
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.osm_file.close()
+
+
+def shard_paths(directory, index):
+    return [os.path.join(directory, '%05d_%s' % (index, os.path.basename(path)))
+            for path in CSV_PATHS]
+
+
+def shape_shard(args):
+    """Pool worker: convert one shard to its own set of headerless csv files.
+    Return their paths, and the summary of the shard's run statistics if
+    asked for. A parse error is raised again as a ValueError naming the
+    shard's byte range, as the parser's own errors cannot be pickled back
+    to the parent process"""
+    (file_in, start, end, index, validate, backend, validate_every, directory,
+     instrumented) = args
+    paths = shard_paths(directory, index)
+    stats = instrument.RunStats() if instrumented else None
+    shard = ShardFile(file_in, start, end)
+    try:
+        shape_to_csv(get_element(shard, tags=ELEMENT_TAGS, backend=backend), paths, validate,
+                     header=False, validate_every=validate_every, stats=stats)
+    except osmstream.PARSE_ERRORS as e:
+        raise ValueError("%s: cannot parse the shard at bytes %d to %d: %s: %s"
+                         % (file_in, start, end, e.__class__.__name__, e))
+    finally:
+        shard.close()
+    if stats is None:
+        return paths, None
+    stats.stop('write')
+    return paths, stats.summary()
+
+
+def append_shard(writers, paths):
+    """Append the csv files of a shard to the outputs and remove them"""
+    for writer, path in zip(writers, paths):
+        with open(path, 'rb') as part:
+            writer.append_csv(part)
+        os.remove(path)
+
+
+def process_map_parallel(file_in, validate, workers, backend=None, validate_every=1,
+                         compression=None, stats=None, format='csv'):
+    """Convert shards of file_in in a pool of worker processes and append the
+    per-shard csv files to the output in shard order, so rows come out in the
+    same order as with a single process. Shards are always csv files, read
+    back into columnar writers for the other formats. stats, an
+    instrument.RunStats, gets the time spent merging and the stages and
+    counts of the workers"""
+
+    shards = find_shards(file_in, workers * SHARDS_PER_WORKER)
+    directory = tempfile.mkdtemp(prefix='osm_shards_', dir=os.path.dirname(os.path.abspath(NODES_PATH)))
+    tasks = [(file_in, start, end, index, validate, backend, validate_every, directory,
+              stats is not None) for index, (start, end) in enumerate(shards)]
+    # Shards are written uncompressed and compressed once, while merging
+    writers = open_table_writers(CSV_PATHS, format, compression=compression)
+    pool = multiprocessing.Pool(workers)
+    try:
+        # imap hands back results in task order, so merging of the first
+        # shards overlaps with conversion of the later ones
+        for paths, summary in pool.imap(shape_shard, tasks):
+            if stats is None:
+                append_shard(writers, paths)
+            else:
+                stats.merge(summary)
+                with stats.timer('merge'):
+                    append_shard(writers, paths)
+        pool.close()
+    finally:
+        # Stops the workers straight away if a shard failed, no-op otherwise
+        pool.terminate()
+        pool.join()
+        csvout.close_writers(writers)
+        shutil.rmtree(directory, ignore_errors=True)
 
 
-# In[ ]:
+# ================================================== #
+#               Checkpointed Conversion              #
+# ================================================== #
+# The file is converted one segment of whole elements at a time, each
+# segment like a shard of the parallel conversion. Once a segment's rows
+# are appended to the csv files and synced to disk, a checkpoint records
+# the input offset reached and the size of every csv file. A resumed run
+# cuts the files back to those sizes and carries on from that offset, so
+# at most one segment is converted twice
+CHECKPOINT_PATH = "process_map.checkpoint"
+CHECKPOINT_BYTES = 128 * 2 ** 20
+
+
+def input_identity(file_in):
+    """What a checkpoint records of the input, to tell if it has changed"""
+    stat = os.stat(file_in)
+    return {'file': os.path.abspath(file_in), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def write_checkpoint(checkpoint_path, identity, offset, sizes):
+    """Replace the checkpoint atomically, so a crash leaves the old or the
+    new one, never a mix"""
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        json.dump({'input': identity, 'offset': offset, 'outputs': sizes}, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, checkpoint_path)
+
+
+def sync_writers(writers):
+    """Write out everything buffered to disk and return the size of each output"""
+    sizes = []
+    for writer in writers:
+        writer.flush()
+        writer.output.flush()
+        os.fsync(writer.output.fileno())
+        sizes.append(writer.output.tell())
+    return sizes
+
+
+def reopen_writers(paths, sizes):
+    """RowWriters appending to paths, cut back to the sizes of a checkpoint"""
+    writers = []
+    try:
+        for path, size in zip(paths, sizes):
+            output = open(path, 'r+b')
+            writers.append(csvout.RowWriter(output))
+            output.seek(0, os.SEEK_END)
+            if output.tell() < size:
+                raise ValueError("%s is shorter than at the checkpoint" % path)
+            output.truncate(size)
+            output.seek(size)
+    except:
+        for writer in writers:
+            writer.output.close()
+        raise
+    return writers
+
+
+def process_map_checkpointed(file_in, validate, checkpoint_path=CHECKPOINT_PATH, resume=False,
+                             backend=None, validate_every=1, stats=None,
+                             segment_bytes=CHECKPOINT_BYTES):
+    """Convert file_in to the csv files segment_bytes of input at a time,
+    with a checkpoint after each segment. With resume, carry on from the
+    checkpoint at checkpoint_path if there is one, otherwise start over.
+    The checkpoint is removed once the whole file is converted"""
+
+    identity = input_identity(file_in)
+    segments = find_shards(file_in, max(1, -(-identity['size'] // segment_bytes)))
+    # Where a checkpoint can be: the start of a segment or the end of the last
+    boundaries = [start for start, _ in segments] + [segments[-1][1] if segments
+                                                     else identity['size']]
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'rb') as f:
+            checkpoint = json.load(f)
+        offset = checkpoint['offset']
+        if checkpoint['input'] != identity or offset not in boundaries:
+            raise ValueError("Checkpoint %s does not match %s, remove it to start over"
+                             % (checkpoint_path, file_in))
+        writers = reopen_writers(CSV_PATHS, checkpoint['outputs'])
+    else:
+        writers = csvout.open_writers(CSV_PATHS, CSV_FIELDS)
+        offset = boundaries[0]
+    directory = checkpoint_path + '.parts'
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    try:
+        write_checkpoint(checkpoint_path, identity, offset, sync_writers(writers))
+        for index, (start, end) in enumerate(segments):
+            if start < offset:
+                continue
+            paths, summary = shape_shard((file_in, start, end, index, validate, backend,
+                                          validate_every, directory, stats is not None))
+            if stats is None:
+                append_shard(writers, paths)
+                write_checkpoint(checkpoint_path, identity, end, sync_writers(writers))
+            else:
+                stats.merge(summary, charged=True)
+                with stats.timer('checkpoint'):
+                    append_shard(writers, paths)
+                    write_checkpoint(checkpoint_path, identity, end, sync_writers(writers))
+    finally:
+        csvout.close_writers(writers)
+        shutil.rmtree(directory, ignore_errors=True)
+    os.remove(checkpoint_path)
 
 
+# ================================================== #
+#               Pipelined Conversion                 #
+# ================================================== #
+# The conversion as a pipeline of threads connected by queues: a parser
+# reading chunks of elements, shapers turning each chunk into the rows of
+# every csv file, and a writer per csv file. Chunks are numbered in file
+# order and their rows handed to the writers in that order, so the files
+# are the same as those of a single thread. At most PIPELINE_DEPTH chunks
+# are in flight between the parser and the writers' queues, which hold
+# PIPELINE_DEPTH row lists each, so a slow disk holds up the parser rather
+# than filling memory. Chunks in flight keep their XML elements alive,
+# which makes every run of the garbage collector longer, hence small chunks
+# and few of them.
+#
+# Each thread keeps its own run statistics, validator and counting
+# classifier. The shared KeyClassifier only ever adds the same decision
+# for a key, and the cleaner caches lock their updates, see lrucache
+PIPELINE_CHUNK_SIZE = 250
+PIPELINE_DEPTH = 4
+DONE = None
+FAILED = 'failed'
+
+
+class RowList(list):
+    """Stand-in for a csvout.RowWriter that keeps the rows, for a writer
+    thread to write out"""
 
+    def writerow(self, row):
+        self.append(row)
+
+    writerows = list.extend
+
+
+class ConversionPipeline(object):
+    """Convert file_in to the csv files with a parser thread, shapers
+    shaping threads and a writer thread per file. The first error raised in
+    any thread stops all of them and is raised again by run()"""
+
+    def __init__(self, file_in, validate, shapers=1, backend=None, validate_every=1,
+                 compression=None, stats=None, csv_paths=CSV_PATHS,
+                 chunk_size=PIPELINE_CHUNK_SIZE, depth=PIPELINE_DEPTH, format='csv'):
+        if (backend or osmstream.DEFAULT_BACKEND) == 'lxml':
+            raise ValueError("The lxml backend clears each element as soon as the next one "
+                             "is read, use the etree or expat backend")
+        self.file_in = file_in
+        self.validate = validate
+        self.shapers = shapers
+        self.backend = backend
+        self.validate_every = validate_every
+        self.compression = compression
+        self.stats = stats
+        self.csv_paths = csv_paths
+        self.format = format
+        self.depth = depth
+        self.compact = compact_output(validate, validate_every)
+        # Chunks start at multiples of validate_every so that the same
+        # elements are validated as when shaping the whole file at once
+        self.chunk_size = max(1, chunk_size // validate_every) * validate_every
+        self.slots = Queue()
+        for _ in range(depth):
+            self.slots.put(None)
+        self.chunks = Queue()
+        self.shaped = Queue()
+        self.summaries = []
+        self.errors = []
+        self.failed = False
+
+    def run(self):
+        writers = open_table_writers(self.csv_paths, self.format, compression=self.compression)
+        queues = [Queue(self.depth) for _ in writers]
+        threads = [self.start(self.parse)]
+        threads.extend(self.start(self.shape) for _ in range(self.shapers))
+        threads.extend(self.start(self.write, writer, queue)
+                       for writer, queue in zip(writers, queues))
+        try:
+            self.dispatch(queues)
+        except:
+            self.failed = True
+            raise
+        finally:
+            if self.failed:
+                self.stop()
+            for queue in queues:
+                queue.put(DONE)
+            for thread in threads:
+                thread.join()
+        if self.stats is not None:
+            for summary in self.summaries:
+                self.stats.merge(summary)
+        if self.errors:
+            error_type, error, traceback = self.errors[0]
+            raise error_type, error, traceback
+
+    def start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def fail(self):
+        """Record the error being handled and tell the main thread"""
+        self.errors.append(sys.exc_info())
+        self.failed = True
+        self.shaped.put(FAILED)
+
+    def stop(self):
+        """Wake up the parser and the shapers so that they see the failure"""
+        self.failed = True
+        self.slots.put(None)
+        for _ in range(self.shapers):
+            self.chunks.put(DONE)
+
+    def new_stats(self):
+        return instrument.RunStats() if self.stats is not None else None
+
+    def parse(self):
+        stats = self.new_stats()
+        elements = timed(stats, 'parse', get_element(self.file_in, tags=ELEMENT_TAGS,
+                                                     backend=self.backend))
+        try:
+            for seq in count():
+                self.slots.get()
+                if self.failed:
+                    break
+                chunk = list(islice(elements, self.chunk_size))
+                if not chunk:
+                    break
+                self.chunks.put((seq, chunk))
+        except Exception:
+            self.fail()
+        finally:
+            elements.close()
+            if stats is not None:
+                self.summaries.append(stats.summary())
+            for _ in range(self.shapers):
+                self.chunks.put(DONE)
+
+    def shape(self):
+        stats = self.new_stats()
+        classifier = key_classifier()
+        if stats is not None:
+            classifier = instrument.CountingClassifier(classifier, stats)
+        validator = schemacheck.CompiledValidator(SCHEMA) if self.validate else None
+        write = write_records if self.compact else write_shaped
+        try:
+            while True:
+                item = self.chunks.get()
+                if item is DONE or self.failed:
+                    break
+                seq, chunk = item
+                rows = [RowList() for _ in self.csv_paths]
+                write(shaping_stages(chunk, self.validate, self.compact, self.validate_every,
+                                     classifier, stats=stats, validator=validator), rows)
+                self.shaped.put((seq, rows))
+        except Exception:
+            self.fail()
+        finally:
+            if stats is not None:
+                self.summaries.append(stats.summary())
+            self.shaped.put(DONE)
+
+    def dispatch(self, queues):
+        """Hand the rows of each chunk to the writers in chunk order"""
+        pending = {}
+        next_seq = 0
+        running = self.shapers
+        while running:
+            item = self.shaped.get()
+            if item is FAILED:
+                return
+            if item is DONE:
+                running -= 1
+                continue
+            seq, rows = item
+            pending[seq] = rows
+            while next_seq in pending:
+                for queue, table_rows in zip(queues, pending.pop(next_seq)):
+                    if table_rows:
+                        queue.put(table_rows)
+                next_seq += 1
+                self.slots.put(None)
+
+    def write(self, writer, queue):
+        stats = self.new_stats()
+        clock = stats.timer if stats is not None else None
+        try:
+            while True:
+                rows = queue.get()
+                if rows is DONE:
+                    break
+                # After a failure only empty the queue, so that the main
+                # thread never blocks on it
+                if not self.failed:
+                    if clock is None:
+                        writer.writerows(rows)
+                    else:
+                        with clock('write'):
+                            writer.writerows(rows)
+        except Exception:
+            self.fail()
+            while queue.get() is not DONE:
+                pass
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                self.fail()
+            if stats is not None:
+                self.summaries.append(stats.summary())
+
+
+def process_map_pipelined(file_in, validate, shapers=1, backend=None, validate_every=1,
+                          compression=None, stats=None, format='csv'):
+    """process_map on a pipeline of threads, so that reading and parsing
+    the XML overlaps with formatting, compressing and writing the csv
+    files. Python threads share one core for Python code, so more shapers
+    only help while others wait for I/O or for compression, which releases
+    the GIL"""
+    ConversionPipeline(file_in, validate, shapers, backend, validate_every, compression,
+                       stats, format=format).run()
+
+
+if __name__ == '__main__':
+    # Note: Validating every element roughly doubles the run time, while
+    # validating one element in 100 costs a few percent at most.
+    process_map(OSM_PATH, validate=True, validate_every=100)
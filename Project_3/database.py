@@ -9,6 +9,9 @@ Import csv files into sqlite database
 import sqlite3
 import csv
 
+import osmdb
+import spatial
+
 sqlite_file = 'osmdb.db'
 conn = sqlite3.connect(sqlite_file)
 cur = conn.cursor()
@@ -17,12 +20,13 @@ cur = conn.cursor()
 # In[6]:
 
 
-#Create tables nodes, nodes_tags, ways, ways_tags, ways_nodes
+#Create tables nodes, nodes_tags, ways, ways_tags, ways_nodes, relations,
+#relations_tags, relation_members
 
 cur.execute ('DROP TABLE IF EXISTS nodes')
 conn.commit()
 
-cur.execute("CREATE TABLE nodes (id, lat, lon, user, uid, version, changeset, timestamp);")
+cur.execute(osmdb.SCHEMA['nodes'])
 with open('nodes_project.csv','rb') as fin:
     dr = csv.DictReader(fin) 
     to_db = [(i['id'].decode("utf-8"), i['lat'].decode("utf-8"), i['lon'].decode("utf-8"), i['user'].decode("utf-8"), i['uid'].decode("utf-8"), i['version'].decode("utf-8"), i['changeset'].decode("utf-8"), i['timestamp'].decode("utf-8"))              for i in dr]
@@ -32,7 +36,7 @@ conn.commit()
 
 cur.execute ('DROP TABLE IF EXISTS nodes_tags')
 conn.commit()
-cur.execute("CREATE TABLE nodes_tags (id, key, value, type);")
+cur.execute(osmdb.SCHEMA['nodes_tags'])
 with open('nodes_tags_project.csv','rb') as fin:
     dr = csv.DictReader(fin) 
     to_db = [(i['id'].decode("utf-8"), i['key'].decode("utf-8"), i['value'].decode("utf-8"), i['type'].decode("utf-8")) for i in dr]
@@ -43,7 +47,7 @@ conn.commit()
 cur.execute ('DROP TABLE IF EXISTS ways')
 conn.commit()
 
-cur.execute("CREATE TABLE ways (id, user, uid, version, changeset, timestamp);")
+cur.execute(osmdb.SCHEMA['ways'])
 with open('ways_project.csv','rb') as fin:
     dr = csv.DictReader(fin) 
     to_db = [(i['id'].decode("utf-8"), i['user'].decode("utf-8"), i['uid'].decode("utf-8"), i['version'].decode("utf-8"), i['changeset'].decode("utf-8"), i['timestamp'].decode("utf-8")) for i in dr]
@@ -53,7 +57,7 @@ conn.commit()
 
 cur.execute ('DROP TABLE IF EXISTS ways_tags')
 conn.commit()
-cur.execute("CREATE TABLE ways_tags (id, key, value, type);")
+cur.execute(osmdb.SCHEMA['ways_tags'])
 with open('ways_tags_project.csv','rb') as fin:
     dr = csv.DictReader(fin) 
     to_db = [(i['id'].decode("utf-8"), i['key'].decode("utf-8"), i['value'].decode("utf-8"), i['type'].decode("utf-8")) for i in dr]
@@ -64,7 +68,7 @@ conn.commit()
 cur.execute ('DROP TABLE IF EXISTS ways_nodes')
 conn.commit()
 
-cur.execute("CREATE TABLE ways_nodes (id, node_id, position);")
+cur.execute(osmdb.SCHEMA['ways_nodes'])
 with open('ways_nodes_project.csv','rb') as fin:
     dr = csv.DictReader(fin) 
     to_db = [(i['id'].decode("utf-8"), i['node_id'].decode("utf-8"), i['position'].decode("utf-8")) for i in dr]
@@ -72,6 +76,43 @@ with open('ways_nodes_project.csv','rb') as fin:
 cur.executemany("INSERT INTO ways_nodes (id, node_id, position) VALUES (?, ?, ?);", to_db)
 conn.commit()
 
+cur.execute ('DROP TABLE IF EXISTS relations')
+conn.commit()
+cur.execute(osmdb.SCHEMA['relations'])
+with open('relations_project.csv','rb') as fin:
+    dr = csv.DictReader(fin) 
+    to_db = [(i['id'].decode("utf-8"), i['user'].decode("utf-8"), i['uid'].decode("utf-8"), i['version'].decode("utf-8"), i['changeset'].decode("utf-8"), i['timestamp'].decode("utf-8")) for i in dr]
+
+cur.executemany("INSERT INTO relations (id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);", to_db)
+conn.commit()
+
+cur.execute ('DROP TABLE IF EXISTS relations_tags')
+conn.commit()
+cur.execute(osmdb.SCHEMA['relations_tags'])
+with open('relations_tags_project.csv','rb') as fin:
+    dr = csv.DictReader(fin) 
+    to_db = [(i['id'].decode("utf-8"), i['key'].decode("utf-8"), i['value'].decode("utf-8"), i['type'].decode("utf-8")) for i in dr]
+
+cur.executemany("INSERT INTO relations_tags (id, key, value, type) VALUES (?, ?, ?, ?);", to_db)
+conn.commit()
+
+cur.execute ('DROP TABLE IF EXISTS relation_members')
+conn.commit()
+cur.execute(osmdb.SCHEMA['relation_members'])
+with open('relation_members_project.csv','rb') as fin:
+    dr = csv.DictReader(fin) 
+    to_db = [(i['id'].decode("utf-8"), i['member_id'].decode("utf-8"), i['member_type'].decode("utf-8"), i['role'].decode("utf-8"), i['position'].decode("utf-8")) for i in dr]
+
+cur.executemany("INSERT INTO relation_members (id, member_id, member_type, role, position) VALUES (?, ?, ?, ?, ?);", to_db)
+conn.commit()
+
+# Index the tag tables and way nodes now that all the rows are in, count
+# the tag values per key for the reports and index the node coordinates
+
+osmdb.create_indexes(conn)
+osmdb.refresh_tag_summary(conn)
+spatial.refresh_spatial_index(conn)
+
 conn.close()
 
 
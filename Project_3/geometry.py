@@ -0,0 +1,183 @@
+
+# coding: utf-8
+
+'''
+Way geometry built in the same pass as the csv conversion. Node coordinates
+are kept in a compact id-sorted store as the nodes go by, and as each way
+arrives its coordinates, length and bounding box are looked up there and
+written to the ways geometry csv, without a join against the nodes table.
+OSM files list all nodes before the ways, so every node a way references is
+known by the time the way is read
+
+'''
+
+from array import array
+from bisect import bisect_left
+from math import asin, cos, radians, sin, sqrt
+
+import csvout
+from records import NodeRecord, WayRecord
+from spatial import EARTH_RADIUS
+
+# array('l') holds 64 bit integers on most platforms, doubles are exact for
+# ids up to 2 ** 53 elsewhere
+ID_TYPECODE = 'l' if array('l').itemsize >= 8 else 'd'
+
+WAY_GEOMETRY_PATH = "ways_geometry_project.csv"
+BATCH_SIZE = 100000
+WAY_GEOMETRY_FIELDS = ['id', 'length', 'min_lat', 'min_lon', 'max_lat', 'max_lon',
+                       'missing_nodes', 'linestring']
+
+
+class NodeCoordinates(object):
+    """node id -> (lat, lon), held in parallel arrays sorted by id: 24 bytes
+    a node instead of the hundred odd of a dict entry and tuple. Ids are
+    expected in increasing order, as in OSM files; otherwise the arrays are
+    sorted before the next lookup. Nodes are added in batches, converting
+    each column to numbers in one go"""
+
+    def __init__(self):
+        self.ids = array(ID_TYPECODE)
+        self.lats = array('d')
+        self.lons = array('d')
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def extend(self, ids, lats, lons):
+        """Add nodes given as lists of ids, latitudes and longitudes, as
+        numbers or strings"""
+        ids = map(int, ids)
+        if ids != sorted(ids) or (self.ids and ids and ids[0] <= self.ids[-1]):
+            self.sorted = False
+        self.ids.extend(ids)
+        self.lats.extend(map(float, lats))
+        self.lons.extend(map(float, lons))
+
+    def sort(self):
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array(ID_TYPECODE, (self.ids[i] for i in order))
+        self.lats = array('d', (self.lats[i] for i in order))
+        self.lons = array('d', (self.lons[i] for i in order))
+        self.sorted = True
+
+    def points(self, refs):
+        """(lat, lon) of each node id in refs that is in the store"""
+        if not self.sorted:
+            self.sort()
+        if not isinstance(refs, array):
+            refs = map(int, refs)
+        ids, lats, lons = self.ids, self.lats, self.lons
+        count = len(ids)
+        found = []
+        for ref in refs:
+            i = bisect_left(ids, ref)
+            if i < count and ids[i] == ref:
+                found.append((lats[i], lons[i]))
+        return found
+
+    def get(self, node_id):
+        """(lat, lon) of a node, or None if it is not in the store"""
+        found = self.points([node_id])
+        return found[0] if found else None
+
+
+def path_length(coordinates):
+    """Length in metres of a path of (lat, lon) points: spatial.haversine
+    over consecutive points, converting and taking the cosine of each
+    latitude once instead of twice"""
+    length = 0
+    previous = None
+    for lat, lon in coordinates:
+        lat, lon = radians(lat), radians(lon)
+        coslat = cos(lat)
+        if previous is not None:
+            lat0, lon0, coslat0 = previous
+            a = sin((lat - lat0) / 2) ** 2 + coslat0 * coslat * sin((lon - lon0) / 2) ** 2
+            length += asin(min(1, sqrt(a)))
+        previous = lat, lon, coslat
+    return 2 * EARTH_RADIUS * length
+
+
+class WayGeometry(object):
+    __slots__ = ('coordinates', 'length', 'bbox', 'missing')
+
+    def __init__(self, coordinates, missing=0):
+        self.coordinates = coordinates
+        self.missing = missing
+        self.length = path_length(coordinates)
+        if coordinates:
+            lats, lons = zip(*coordinates)
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+        else:
+            self.bbox = None
+
+
+def way_geometry(refs, nodes):
+    """WayGeometry of the way through the node ids refs, skipping the nodes
+    missing from the store, as at the edges of an extract"""
+    coordinates = nodes.points(refs)
+    return WayGeometry(coordinates, len(refs) - len(coordinates))
+
+
+def geometry_row(way_id, geometry):
+    if geometry.bbox is None:
+        return [way_id, '0.0', '', '', '', '', geometry.missing, '']
+    linestring = ''
+    if len(geometry.coordinates) > 1:
+        linestring = 'LINESTRING (%s)' % ', '.join('%.7f %.7f' % (lon, lat)
+                                                   for lat, lon in geometry.coordinates)
+    return [way_id, '%.1f' % geometry.length] + ['%.7f' % v for v in geometry.bbox] + [
+        geometry.missing, linestring]
+
+
+class GeometryWriter(object):
+    """Collect node coordinates and write the geometry of each way to path.
+    Nodes are buffered and stored a batch at a time"""
+
+    def __init__(self, path=WAY_GEOMETRY_PATH, header=True, compression=None,
+                 batch_size=BATCH_SIZE):
+        self.nodes = NodeCoordinates()
+        self.pending = []
+        self.batch_size = batch_size
+        self.writer = csvout.open_writers([path], [WAY_GEOMETRY_FIELDS] if header else None,
+                                          compression)[0]
+
+    def add_node(self, node_id, lat, lon):
+        self.add_values((node_id, lat, lon))
+
+    def add_values(self, values):
+        """Add a node from a sequence starting with its id, lat and lon, as
+        the values of a NodeRecord"""
+        self.pending.append(values)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self.nodes.extend([v[0] for v in pending], [v[1] for v in pending],
+                              [v[2] for v in pending])
+
+    def add_way(self, way_id, refs):
+        if self.pending:
+            self.flush()
+        self.writer.writerow(geometry_row(way_id, way_geometry(refs, self.nodes)))
+
+    def close(self):
+        self.writer.close()
+
+
+def track_records(records, writer):
+    """Pass the records of data.shape_record through unchanged, feeding the
+    nodes and ways to a GeometryWriter on the way"""
+    add_values = writer.add_values
+    for record in records:
+        if record is not None:
+            if record.__class__ is NodeRecord:
+                # values are in data.NODE_FIELDS order: id, lat, lon, ...
+                add_values(record.values)
+            elif record.__class__ is WayRecord:
+                writer.add_way(record.id, record.node_refs)
+        yield record
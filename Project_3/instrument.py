@@ -0,0 +1,252 @@
+
+# coding: utf-8
+
+'''
+Run statistics for the conversion (data.process_map) and the database load
+(osmdb.load_osm): time spent in each stage of the pipeline, counts of the
+elements, tags, way node refs and relation members processed, of the tags
+dropped for problem characters or by the postcode and city filters, and
+the peak memory use, written out as a JSON run report. A cProfile dump of
+the whole run can be asked for as well.
+
+    data.process_map('sample.osm', validate=False, report_path='run.json',
+                     profile_path='run.prof')
+
+Stages are the layers of the generator pipeline: parsing the XML, shaping
+(cleaning excluded), cleaning tag values, validation, counting (the cost
+of the instrumentation itself) and writing. Time is charged to the stage
+that spends it, so the stages add up to the run time
+
+'''
+
+import cProfile
+import json
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from records import NodeRecord, WayRecord
+
+
+def peak_rss():
+    """Peak resident set size in kB of this process and of its largest
+    finished child process (Linux reports ru_maxrss in kB)"""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class RunStats(object):
+    """Stage timers and counters of one run.
+
+    Each timer measures the time spent in its stage minus the time other
+    timers measured meanwhile, so a stage wrapping the iterator of the one
+    before it is only charged for its own work. `charged` is the total
+    measured so far; what is left of the run time when it is stopped goes
+    to the consuming stage, e.g. writing the csv files."""
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.charged = 0.0
+        self.start = time.time()
+        self.seconds = None
+
+    def charge(self, stage, spent, charged_before):
+        """Charge spent seconds, minus those charged to other stages since
+        charged_before, to stage"""
+        self.times[stage] += spent - (self.charged - charged_before)
+        self.charged = charged_before + spent
+
+    def timed(self, stage, iterable):
+        """Iterate over iterable, charging the time taken to produce each
+        item to stage"""
+        clock = time.time
+        times = self.times
+        iterator = iter(iterable)
+        while True:
+            start, charged = clock(), self.charged
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.charge(stage, clock() - start, charged)
+                return
+            # charge(), inlined as this runs for every element
+            spent = clock() - start
+            times[stage] += spent - (self.charged - charged)
+            self.charged = charged + spent
+            yield item
+
+    def timed_call(self, stage, func):
+        """func, charging the time of each call to stage"""
+        clock = time.time
+
+        def call(*args):
+            start, charged = clock(), self.charged
+            try:
+                return func(*args)
+            finally:
+                self.charge(stage, clock() - start, charged)
+        return call
+
+    @contextmanager
+    def timer(self, stage):
+        start, charged = time.time(), self.charged
+        try:
+            yield
+        finally:
+            self.charge(stage, time.time() - start, charged)
+
+    def merge(self, summary, charged=False):
+        """Add the times and counters of another run, e.g. a worker
+        process. They are not part of this run's own time, unless charged
+        as when this run waited for the other one to finish"""
+        for stage, seconds in summary['times'].iteritems():
+            self.times[stage] += seconds
+            if charged:
+                self.charged += seconds
+        for counter, n in summary['counters'].iteritems():
+            self.counters[counter] += n
+
+    def stop(self, remainder):
+        """End the run, charging the time not measured by any timer to
+        the stage remainder"""
+        self.seconds = time.time() - self.start
+        self.times[remainder] += max(0.0, self.seconds - self.charged)
+        self.charged = self.seconds
+
+    def summary(self):
+        """Times and counters as plain dicts, to send between processes"""
+        return {'times': dict(self.times), 'counters': dict(self.counters)}
+
+    def report(self, **info):
+        """The run report: info, then the time, share of the total stage
+        time and elements per second of each stage, the counters and the
+        peak memory use"""
+        seconds = self.seconds if self.seconds is not None else time.time() - self.start
+        elements = self.counters.get('elements', 0)
+        total = sum(self.times.itervalues()) or 1.0
+        rss, children_rss = peak_rss()
+        counters = dict(self.counters)
+        if 'tags_kept' in counters:
+            # Every tag read is either kept or dropped
+            counters['tags'] = counters['tags_kept'] + sum(
+                n for counter, n in counters.iteritems() if counter.startswith('tags_dropped_'))
+        report = dict(info)
+        report.update({
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+            'seconds': round(seconds, 6),
+            'elements_per_second': round(elements / seconds, 1) if seconds else None,
+            'stages': dict((stage, {
+                'seconds': round(spent, 6),
+                'share': round(spent / total, 4),
+                'elements_per_second': round(elements / spent, 1) if spent > 0 else None,
+            }) for stage, spent in self.times.iteritems()),
+            'counters': counters,
+            'peak_rss_kb': rss,
+            'peak_rss_children_kb': children_rss,
+        })
+        return report
+
+    def write_report(self, path, **info):
+        report = self.report(**info)
+        with open(path, 'wb') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return report
+
+
+class CountingClassifier(object):
+    """Stand-in for a data.KeyClassifier that counts the tags dropped for
+    problem characters, and times the cleaners and counts the values they
+    drop, per full key. It keeps its own cache of decisions so that
+    classifying a tag still costs a single call"""
+
+    def __init__(self, classifier, stats):
+        self.classifier = classifier
+        self.stats = stats
+        self.counters = stats.counters
+        self.decisions = {}
+
+    def classify(self, k):
+        try:
+            decision = self.decisions[k]
+        except KeyError:
+            decision = self.counted_decision(k, self.classifier.classify(k))
+            if len(self.decisions) < self.classifier.max_keys:
+                self.decisions[k] = decision
+        if decision is None:
+            self.counters['tags_dropped_problemchars'] += 1
+        return decision
+
+    def counted_decision(self, k, decision):
+        if decision is None or decision[2] is None:
+            return decision
+        key, tag_type, cleaner = decision
+        clean = self.stats.timed_call('clean', cleaner)
+        counters = self.counters
+        dropped = 'tags_dropped_' + k
+
+        def counted(value):
+            value = clean(value)
+            if value is None:
+                counters[dropped] += 1
+            return value
+        return key, tag_type, counted
+
+
+def count_records(records, stats):
+    """Pass the records of data.shape_record through, counting them, their
+    tags, way node refs and relation members"""
+    counters = stats.counters
+    for record in records:
+        if record is not None:
+            counters['elements'] += 1
+            counters['tags_kept'] += len(record.tags)
+            if record.__class__ is NodeRecord:
+                counters['nodes'] += 1
+            elif record.__class__ is WayRecord:
+                counters['ways'] += 1
+                counters['nd_refs'] += len(record.node_refs)
+            else:
+                counters['relations'] += 1
+                counters['members'] += len(record.members)
+        yield record
+
+
+# Key of the tags, and of the way nodes or members, of each shaped element
+SHAPED_KEYS = {
+    'node': ('nodes', 'node_tags', None, None),
+    'way': ('ways', 'way_tags', 'way_nodes', 'nd_refs'),
+    'relation': ('relations', 'relation_tags', 'relation_members', 'members'),
+}
+
+
+def count_shaped(shaped, stats):
+    """count_records for the (tag, shaped element) pairs of data.shaped_elements"""
+    counters = stats.counters
+    for tag, el in shaped:
+        if el:
+            counter, tags_key, children_key, children_counter = SHAPED_KEYS[tag]
+            counters['elements'] += 1
+            counters[counter] += 1
+            counters['tags_kept'] += len(el[tags_key])
+            if children_key is not None:
+                counters[children_counter] += len(el[children_key])
+        yield tag, el
+
+
+@contextmanager
+def profiled(path=None):
+    """Run the block under cProfile and dump the stats to path, for pstats
+    or snakeviz. Does nothing without a path"""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,81 @@
+
+# coding: utf-8
+
+'''
+Bounded least recently used cache for the one argument cleaning functions,
+with hit and miss counters
+
+'''
+
+import threading
+from collections import namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """Wrap func(arg) so that repeated arguments are answered from a cache of
+    at most maxsize entries.
+
+    Entries are kept in two generations of maxsize / 2 each. Hits in the
+    current generation cost one dict lookup; hits in the previous one are
+    promoted to the current one. When the current generation is full it
+    becomes the previous one and the old previous generation is dropped, so
+    the entries evicted are those not used since the last switch. This
+    approximates least recently used eviction without reordering a list on
+    every hit.
+
+    Misses and promotions are made under a lock, so the cache can be shared
+    by threads (data.ConversionPipeline); hits stay lock free, a dict lookup
+    being atomic, at the price of a hit count that may miss a few hits
+    """
+
+    def __init__(self, func, maxsize=100000):
+        if maxsize < 2:
+            raise ValueError("maxsize must be at least 2")
+        self.func = func
+        self.maxsize = maxsize
+        self.generation_size = maxsize // 2
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __call__(self, key):
+        try:
+            result = self.current[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+
+        with self.lock:
+            try:
+                result = self.previous.pop(key)
+                self.hits += 1
+            except KeyError:
+                result = self.func(key)
+                self.misses += 1
+            if len(self.current) >= self.generation_size:
+                self.previous = self.current
+                self.current = {}
+            self.current[key] = result
+        return result
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self.current) + len(self.previous))
+
+    def clear(self):
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+
+def lru_cache(maxsize=100000):
+    """Decorator form of LRUCache"""
+    def decorator(func):
+        return LRUCache(func, maxsize)
+    return decorator
@@ -8,24 +8,29 @@ Parse the OSM , count unqiue tags and types of keys present
 
 '''
 
-import xml.etree.cElementTree as ET
 import pprint
 import re
 
+import osmstream
+
 #Count the different types of tags in the present file
 
 OSM_FILE = 'new_delhi.osm'
 
 def count_tags(filename):
     tags = {}
-    for event, elem in ET.iterparse(filename):
-        if elem.tag in tags: 
-            tags[elem.tag] += 1
-        else:
-            tags[elem.tag] = 1
+    stream = osmstream.ElementStream(filename)
+    for element in stream:
+        for elem in element.iter():
+            if elem.tag in tags: 
+                tags[elem.tag] += 1
+            else:
+                tags[elem.tag] = 1
+    tags[stream.root.tag] = tags.get(stream.root.tag, 0) + 1
     return tags
 
-pprint.pprint(count_tags(OSM_FILE))
+if __name__ == '__main__':
+    pprint.pprint(count_tags(OSM_FILE))
 
 
 # In[2]:
@@ -54,8 +59,9 @@ def key_type(element, keys):
 
 def process_map(filename):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    for element in osmstream.iter_elements(filename):
+        for tag in element.iter("tag"):
+            keys = key_type(tag, keys)
 
     return keys
 
@@ -63,7 +69,8 @@ def test():
     keys = process_map(OSM_FILE)
     pprint.pprint(keys)
     
-test()
+if __name__ == '__main__':
+    test()
 
 
 # In[ ]:
@@ -0,0 +1,107 @@
+
+# coding: utf-8
+
+'''
+Apply an OSM change file (.osc, or a compressed one such as the .osc.gz
+replication diffs) to an existing osmdb.db, touching only the nodes and
+ways it creates, modifies or deletes, instead of reloading the whole map
+
+'''
+
+import sqlite3
+import sys
+import time
+
+import data
+import osmdb
+import osmstream
+
+ELEMENT_TABLES = {'node': 'nodes', 'way': 'ways', 'relation': 'relations'}
+CHILD_TABLES = {'node': ['nodes_tags'], 'way': ['ways_tags', 'ways_nodes'],
+                'relation': ['relations_tags', 'relation_members']}
+TAG_TABLES = {'node': 'nodes_tags', 'way': 'ways_tags', 'relation': 'relations_tags'}
+# tag_value_counts only counts node and way tags
+COUNTED_TAGS = ('node', 'way')
+INSERT_SQL = dict((table, osmdb.insert_sql(table, fields)) for table, fields in osmdb.TABLES)
+CHANGE_ACTIONS = ('create', 'modify', 'delete')
+
+
+def iter_changes(osc_file, tags=data.ELEMENT_TAGS, backend=None):
+    """Yield (action, element) for each element in the create, modify and
+    delete blocks of an osmChange file, which may be compressed. Elements
+    are streamed from within the blocks by osmstream and cleared once
+    consumed, so even a single large block does not build up in memory"""
+    stream = osmstream.ElementStream(osc_file, tags, backend, parent_tags=CHANGE_ACTIONS)
+    for elem in stream:
+        yield stream.parent.tag, elem
+
+
+def count_tags(cur, tags, delta):
+    """Add delta to the tag_value_counts entry of each (key, value) in tags"""
+    if delta > 0:
+        cur.executemany('INSERT OR IGNORE INTO tag_value_counts (key, value, count) '
+                        'VALUES (?, ?, 0)', tags)
+    cur.executemany('UPDATE tag_value_counts SET count = count + %d '
+                    'WHERE key = ? AND value = ?' % delta, tags)
+
+
+def delete_element(cur, tag, element_id):
+    """Remove a node, way or relation and its tags, way nodes, members and
+    spatial index entry"""
+    if tag in COUNTED_TAGS:
+        old_tags = cur.execute('SELECT key, value FROM %s WHERE id = ?' % TAG_TABLES[tag],
+                               (element_id,)).fetchall()
+        count_tags(cur, old_tags, -1)
+    cur.execute('DELETE FROM %s WHERE id = ?' % ELEMENT_TABLES[tag], (element_id,))
+    if tag == 'node':
+        cur.execute('DELETE FROM nodes_rtree WHERE id = ?', (element_id,))
+    for table in CHILD_TABLES[tag]:
+        cur.execute('DELETE FROM %s WHERE id = ?' % table, (element_id,))
+
+
+def insert_element(cur, tag, el):
+    """Insert a shaped node, way or relation with its tags, way nodes,
+    members and spatial index entry"""
+    for table, rows in osmdb.element_rows(tag, el):
+        if rows:
+            cur.executemany(INSERT_SQL[table], rows)
+    if tag in COUNTED_TAGS:
+        count_tags(cur, [(t['key'], t['value']) for t in el[tag + '_tags']], 1)
+    if tag == 'node':
+        node = el['node']
+        cur.execute('INSERT INTO nodes_rtree (id, min_lat, max_lat, min_lon, max_lon) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (node['id'], node['lat'], node['lat'], node['lon'], node['lon']))
+
+
+def apply_changes(osc_file, sqlite_file=osmdb.SQLITE_FILE, backend=None):
+    """Apply every node, way and relation change of osc_file to sqlite_file in a single
+    transaction. Created and modified elements are cleaned and shaped with
+    data.shape_element like a full load. Return the count of changes applied
+    per (action, element type). backend selects the XML parser, see
+    osmstream.BACKENDS"""
+    start = time.time()
+    counts = {}
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        with conn:
+            cur = conn.cursor()
+            for action, elem in iter_changes(osc_file, backend=backend):
+                # Modify replaces the whole element, and create does the same
+                # so that applying a change file twice is harmless
+                delete_element(cur, elem.tag, elem.attrib['id'])
+                if action in ('create', 'modify'):
+                    el = data.shape_element(elem)
+                    if el:
+                        insert_element(cur, elem.tag, el)
+                counts[(action, elem.tag)] = counts.get((action, elem.tag), 0) + 1
+            cur.execute('DELETE FROM tag_value_counts WHERE count <= 0')
+    finally:
+        conn.close()
+
+    print "Applied %d changes in %.2f s" % (sum(counts.values()), time.time() - start)
+    return counts
+
+
+if __name__ == '__main__':
+    apply_changes(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else osmdb.SQLITE_FILE)
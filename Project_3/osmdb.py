@@ -0,0 +1,271 @@
+
+# coding: utf-8
+
+'''
+Load the OSM file straight into the sqlite database, without going through
+the csv files. Shaped elements are inserted in chunks with executemany, one
+transaction per chunk, so memory use stays constant
+
+'''
+
+import sqlite3
+import sys
+import time
+
+import data
+import instrument
+import spatial
+
+SQLITE_FILE = 'osmdb.db'
+
+# Tables in the same column order as the csv files written by data.py
+TABLES = [
+    ('nodes', data.NODE_FIELDS),
+    ('nodes_tags', data.NODE_TAGS_FIELDS),
+    ('ways', data.WAY_FIELDS),
+    ('ways_tags', data.WAY_TAGS_FIELDS),
+    ('ways_nodes', data.WAY_NODES_FIELDS),
+    ('relations', data.RELATION_FIELDS),
+    ('relations_tags', data.RELATION_TAGS_FIELDS),
+    ('relation_members', data.RELATION_MEMBERS_FIELDS),
+]
+
+# Settings for bulk loading: no rollback journal and no fsync, as a failed
+# load is simply run again, and a large page cache (negative sizes are in kB)
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -200000',
+    'PRAGMA temp_store = MEMORY',
+]
+
+CHUNK_SIZE = 50000
+
+# Typed tables. Element ids are the primary keys of nodes and ways, and way
+# nodes are clustered by way in a WITHOUT ROWID table. Tag tables keep their
+# rowid, as nothing in the data guarantees a unique key per element and type
+SCHEMA = {
+    'nodes': """CREATE TABLE nodes (
+        id INTEGER PRIMARY KEY NOT NULL,
+        lat REAL,
+        lon REAL,
+        user TEXT,
+        uid INTEGER,
+        version TEXT,
+        changeset INTEGER,
+        timestamp TEXT)""",
+    'nodes_tags': """CREATE TABLE nodes_tags (
+        id INTEGER NOT NULL,
+        key TEXT,
+        value TEXT,
+        type TEXT)""",
+    'ways': """CREATE TABLE ways (
+        id INTEGER PRIMARY KEY NOT NULL,
+        user TEXT,
+        uid INTEGER,
+        version TEXT,
+        changeset INTEGER,
+        timestamp TEXT)""",
+    'ways_tags': """CREATE TABLE ways_tags (
+        id INTEGER NOT NULL,
+        key TEXT,
+        value TEXT,
+        type TEXT)""",
+    'ways_nodes': """CREATE TABLE ways_nodes (
+        id INTEGER NOT NULL,
+        node_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        PRIMARY KEY (id, position)) WITHOUT ROWID""",
+    'relations': """CREATE TABLE relations (
+        id INTEGER PRIMARY KEY NOT NULL,
+        user TEXT,
+        uid INTEGER,
+        version TEXT,
+        changeset INTEGER,
+        timestamp TEXT)""",
+    'relations_tags': """CREATE TABLE relations_tags (
+        id INTEGER NOT NULL,
+        key TEXT,
+        value TEXT,
+        type TEXT)""",
+    'relation_members': """CREATE TABLE relation_members (
+        id INTEGER NOT NULL,
+        member_id INTEGER NOT NULL,
+        member_type TEXT NOT NULL,
+        role TEXT,
+        position INTEGER NOT NULL,
+        PRIMARY KEY (id, position)) WITHOUT ROWID""",
+}
+
+# Built once the tables are loaded, which is much faster than keeping them
+# up to date row by row during the bulk insert
+INDEXES = [
+    'CREATE INDEX nodes_tags_key_value ON nodes_tags (key, value)',
+    'CREATE INDEX nodes_tags_id ON nodes_tags (id)',
+    'CREATE INDEX ways_tags_key_value ON ways_tags (key, value)',
+    'CREATE INDEX ways_tags_id ON ways_tags (id)',
+    'CREATE INDEX ways_nodes_node_id ON ways_nodes (node_id)',
+    'CREATE INDEX relations_tags_key_value ON relations_tags (key, value)',
+    'CREATE INDEX relations_tags_id ON relations_tags (id)',
+    'CREATE INDEX relation_members_member ON relation_members (member_type, member_id)',
+]
+
+
+def insert_sql(table, fields):
+    return 'INSERT INTO %s (%s) VALUES (%s);' % (
+        table, ', '.join(fields), ', '.join('?' * len(fields)))
+
+
+def create_tables(conn, schema=SCHEMA):
+    """Drop and create the tables of TABLES"""
+    cur = conn.cursor()
+    for table, _ in TABLES:
+        cur.execute('DROP TABLE IF EXISTS %s' % table)
+        cur.execute(schema[table])
+    conn.commit()
+
+
+def create_indexes(conn, indexes=INDEXES):
+    """Build the indexes of the loaded tables and gather statistics for the
+    query planner"""
+    cur = conn.cursor()
+    for index in indexes:
+        cur.execute(index)
+    cur.execute('ANALYZE')
+    conn.commit()
+
+
+TAG_SUMMARY_SQL = [
+    'DROP TABLE IF EXISTS tag_value_counts',
+    """CREATE TABLE tag_value_counts (
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (key, value)) WITHOUT ROWID""",
+    """INSERT INTO tag_value_counts (key, value, count)
+        SELECT key, value, COUNT(*)
+        FROM (SELECT key, value FROM nodes_tags UNION ALL SELECT key, value FROM ways_tags)
+        WHERE key IS NOT NULL AND value IS NOT NULL
+        GROUP BY key, value""",
+    'CREATE INDEX tag_value_counts_key_count ON tag_value_counts (key, count DESC, value DESC)',
+]
+
+
+def refresh_tag_summary(conn):
+    """Rebuild tag_value_counts, the number of node and way tags with each
+    key and value, so that the per-key reports of sqlqueries.py are an index
+    lookup instead of a scan of both tag tables"""
+    with conn:
+        for sql in TAG_SUMMARY_SQL:
+            conn.execute(sql)
+
+
+class ChunkedInserter(object):
+    """Collect rows per table and insert them with executemany once chunk_size
+    rows are waiting, committing one transaction per chunk"""
+
+    def __init__(self, conn, chunk_size=CHUNK_SIZE):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.sql = dict((table, insert_sql(table, fields)) for table, fields in TABLES)
+        self.rows = dict((table, []) for table, _ in TABLES)
+        self.pending = 0
+        self.counts = dict((table, 0) for table, _ in TABLES)
+
+    def extend(self, table, rows):
+        self.rows[table].extend(rows)
+        self.pending += len(rows)
+        if self.pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        with self.conn:
+            for table, rows in self.rows.iteritems():
+                if rows:
+                    self.conn.executemany(self.sql[table], rows)
+                    self.counts[table] += len(rows)
+                    del rows[:]
+        self.pending = 0
+
+
+def element_rows(tag, el):
+    """Split a shaped element into (table, list of row tuples) pairs"""
+    if tag == 'node':
+        yield 'nodes', [tuple(el['node'][f] for f in data.NODE_FIELDS)]
+        yield 'nodes_tags', [tuple(t[f] for f in data.NODE_TAGS_FIELDS) for t in el['node_tags']]
+    elif tag == 'way':
+        yield 'ways', [tuple(el['way'][f] for f in data.WAY_FIELDS)]
+        yield 'ways_tags', [tuple(t[f] for f in data.WAY_TAGS_FIELDS) for t in el['way_tags']]
+        yield 'ways_nodes', [tuple(n[f] for f in data.WAY_NODES_FIELDS) for n in el['way_nodes']]
+    elif tag == 'relation':
+        yield 'relations', [tuple(el['relation'][f] for f in data.RELATION_FIELDS)]
+        yield 'relations_tags', [tuple(t[f] for f in data.RELATION_TAGS_FIELDS)
+                                 for t in el['relation_tags']]
+        yield 'relation_members', [tuple(m[f] for f in data.RELATION_MEMBERS_FIELDS)
+                                   for m in el['relation_members']]
+
+
+def build_indexes(conn, indexes=INDEXES):
+    """The indexes, tag summary and spatial index of the loaded tables"""
+    create_indexes(conn, indexes)
+    refresh_tag_summary(conn)
+    spatial.refresh_spatial_index(conn)
+
+
+def shaped_for_load(file_in, validate, stats=None):
+    """(tag, shaped element) pairs of file_in, timed and counted per stage
+    if stats (an instrument.RunStats) is given"""
+    elements = data.get_element(file_in, tags=data.ELEMENT_TAGS)
+    if stats is None:
+        return data.shaped_elements(elements, validate)
+    classifier = instrument.CountingClassifier(data.key_classifier(), stats)
+    shaped = stats.timed('shape', data.shape_each(stats.timed('parse', elements),
+                                                  classifier=classifier))
+    if validate is True:
+        shaped = stats.timed('validate', data.validate_shaped(shaped))
+    return stats.timed('count', instrument.count_shaped(shaped, stats))
+
+
+def load_osm(file_in, sqlite_file=SQLITE_FILE, validate=False, chunk_size=CHUNK_SIZE,
+             schema=SCHEMA, indexes=INDEXES, report_path=None, profile_path=None):
+    """Shape every node, way and relation of file_in and insert it into
+    sqlite_file, replacing the existing tables, then build the indexes, the
+    tag summary and the spatial index. Return the row
+    count of each table. report_path and profile_path write a run report
+    and cProfile stats as for data.process_map"""
+    start = time.time()
+    stats = instrument.RunStats() if report_path else None
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        with instrument.profiled(profile_path):
+            for pragma in BULK_LOAD_PRAGMAS:
+                conn.execute(pragma)
+            create_tables(conn, schema)
+
+            inserter = ChunkedInserter(conn, chunk_size)
+            for tag, el in shaped_for_load(file_in, validate, stats):
+                if el:
+                    for table, rows in element_rows(tag, el):
+                        inserter.extend(table, rows)
+            inserter.flush()
+            if stats is None:
+                build_indexes(conn, indexes)
+            else:
+                with stats.timer('index'):
+                    build_indexes(conn, indexes)
+    finally:
+        conn.close()
+
+    elapsed = time.time() - start
+    total = sum(inserter.counts.values())
+    print "Loaded %d rows in %.1f s (%.0f rows/s)" % (total, elapsed, total / elapsed)
+    if stats is not None:
+        # The time no other stage was charged for went into the inserts
+        stats.stop('insert')
+        stats.write_report(report_path, file=file_in, sqlite_file=sqlite_file,
+                           validate=validate, rows=inserter.counts, profile=profile_path)
+    return inserter.counts
+
+
+if __name__ == '__main__':
+    load_osm(sys.argv[1] if len(sys.argv) > 1 else data.OSM_PATH)
@@ -0,0 +1,477 @@
+
+# coding: utf-8
+
+'''
+Shared streaming readers for OSM XML files. Memory stays flat whatever the
+file size because every top level element is cleared from the tree once it
+has been handed out, or, for the raw reader, never parsed at all.
+
+Files may be compressed with gzip, bzip2, xz or zstd (.osm.gz, .osm.bz2, ...),
+recognised by their first bytes. gzip and bzip2 are decompressed in a
+thread, xz and zstd by their command line tool in a separate process, so
+decompression overlaps with parsing in either case
+
+'''
+
+import bz2
+import mmap
+import re
+import subprocess
+import threading
+import xml.etree.cElementTree as ET
+import zlib
+from Queue import Queue
+from xml.parsers import expat
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# Start of a top level element. '<' cannot appear unescaped inside attribute
+# values, so this only ever matches real tags, and node, way and relation
+# elements are never nested in one another.
+TOP_LEVEL_START = re.compile(r'<(node|way|relation)[\s/>]')
+OSM_END = '</osm>'
+
+# First bytes of each kind of compressed file
+MAGIC = [
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bzip2'),
+    ('\xfd7zXZ\x00', 'xz'),
+    ('\x28\xb5\x2f\xfd', 'zstd'),
+]
+DECOMPRESSORS = {
+    'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'bzip2': bz2.BZ2Decompressor,
+}
+DECOMPRESS_COMMANDS = {
+    'xz': ['xz', '-dc'],
+    'zstd': ['zstd', '-dcq'],
+}
+READ_SIZE = 2 ** 18
+QUEUED_CHUNKS = 8
+
+
+def compression(path):
+    """'gzip', 'bzip2', 'xz' or 'zstd' if the file at path is compressed,
+    otherwise None"""
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    for magic, kind in MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+class ThreadedDecompressor(object):
+    """Read-only file object over the decompressed content of a gzip or
+    bzip2 file. A thread reads and decompresses the file a chunk at a time
+    into a bounded queue, zlib and bz2 releasing the GIL while they work, so
+    the next chunk is being decompressed while the parser reads this one.
+    Concatenated members, as written by pigz or lbzip2, are read one after
+    the other"""
+
+    def __init__(self, path, kind):
+        self.raw = open(path, 'rb')
+        self.new_decompressor = DECOMPRESSORS[kind]
+        self.chunks = Queue(QUEUED_CHUNKS)
+        self.chunk = ''
+        self.pos = 0
+        self.done = False
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.decompress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress(self):
+        try:
+            decompressor = self.new_decompressor()
+            while not self.closed:
+                data = self.raw.read(READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    try:
+                        chunk = decompressor.decompress(data)
+                    except EOFError:
+                        # A bzip2 member ended with the previous read, so
+                        # its decompressor had no unused data to hand on
+                        decompressor = self.new_decompressor()
+                        continue
+                    if chunk:
+                        self.chunks.put(chunk)
+                    # Data after the end of a member starts the next one.
+                    # A finished zlib decompressor passes whole reads on
+                    # here too
+                    data = decompressor.unused_data
+                    if data:
+                        decompressor = self.new_decompressor()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put(None)
+
+    def read(self, size=-1):
+        # Parsers read a few kB at a time, so hand out slices of the current
+        # chunk rather than copying what is left of it on every read
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.chunk):
+                if self.done:
+                    break
+                chunk = self.chunks.get()
+                if chunk is None:
+                    self.done = True
+                    if self.error is not None:
+                        raise IOError("Cannot decompress %s: %s" % (self.raw.name, self.error))
+                    break
+                self.chunk, self.pos = chunk, 0
+            part = self.chunk[self.pos:self.pos + size] if size > 0 else self.chunk[self.pos:]
+            self.pos += len(part)
+            size -= len(part) if size > 0 else 0
+            parts.append(part)
+        return ''.join(parts)
+
+    def close(self):
+        self.closed = True
+        # Unblock the thread if it is waiting for room in the queue
+        while not self.done:
+            self.done = self.chunks.get() is None
+        self.thread.join()
+        self.raw.close()
+
+
+class DecompressPipe(object):
+    """Read-only file object over the output of a decompression command,
+    for the formats the standard library cannot read"""
+
+    def __init__(self, path, kind):
+        try:
+            self.process = subprocess.Popen(DECOMPRESS_COMMANDS[kind] + [path],
+                                            stdout=subprocess.PIPE, bufsize=READ_SIZE)
+        except OSError:
+            raise IOError("Reading %s files needs the %s command"
+                          % (kind, DECOMPRESS_COMMANDS[kind][0]))
+        self.path = path
+        self.command = DECOMPRESS_COMMANDS[kind][0]
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data and size != 0 and self.process.wait() != 0:
+            raise IOError("Cannot decompress %s: %s exited with status %d"
+                          % (self.path, self.command, self.process.returncode))
+        return data
+
+    def close(self):
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+def open_osm(path):
+    """Open an OSM file for reading bytes, decompressing it if it is
+    compressed"""
+    kind = compression(path)
+    if kind in DECOMPRESSORS:
+        return ThreadedDecompressor(path, kind)
+    if kind in DECOMPRESS_COMMANDS:
+        return DecompressPipe(path, kind)
+    return open(path, 'rb')
+
+
+class ElementStream(object):
+    """Iterate over the top level elements (node, way, relation, ...) of an
+    OSM file, optionally only those whose tag is in `tags`.
+
+    Each element is complete (children included) when it is yielded and is
+    removed from the tree as soon as the consumer asks for the next one, so
+    do not hold on to elements across iterations. The root element is
+    available as `root` once iteration has started.
+
+    `backend` names the parser used, one of BACKENDS: the standard library
+    ElementTree ('etree'), lxml ('lxml') or a plain expat handler building
+    lightweight Record objects ('expat'). All of them hand out objects with
+    the tag, attrib and iter() used by the auditors and shape_element.
+
+    With `parent_tags` the elements handed out are one level down, the
+    children of the top level elements whose tag is in parent_tags, such as
+    the nodes and ways of the create, modify and delete blocks of an
+    osmChange file. `parent` is then the top level element being read,
+    without its children.
+    """
+
+    def __init__(self, osm_file, tags=None, backend=None, parent_tags=None):
+        self.osm_file = osm_file
+        self.tags = tags
+        self.backend = backend or DEFAULT_BACKEND
+        self.parent_tags = parent_tags
+        self.root = None
+        self.parent = None
+
+    def __iter__(self):
+        if hasattr(self.osm_file, 'read'):
+            return BACKENDS[self.backend](self)
+        return self.read_path(self.osm_file)
+
+    def read_path(self, path):
+        """Parse the file at path, decompressing it on the way if needed"""
+        self.osm_file = open_osm(path)
+        try:
+            for elem in BACKENDS[self.backend](self):
+                yield elem
+        finally:
+            self.osm_file.close()
+            self.osm_file = path
+
+
+def iterparse_elements(stream, context):
+    """Hand out the elements of stream from the start and end events of an
+    ElementTree or lxml iterparse context"""
+    if stream.parent_tags is not None:
+        return child_elements(stream, context)
+    return top_level_elements(stream, context)
+
+
+def top_level_elements(stream, context):
+    _, stream.root = next(context)
+    depth = 1
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if stream.tags is None or elem.tag in stream.tags:
+                yield elem
+            # Clear skipped elements too, otherwise filtering out e.g. all
+            # nodes would keep them in memory until the next yield
+            stream.root.clear()
+
+
+def child_elements(stream, context):
+    """top_level_elements one level down, for stream.parent_tags"""
+    _, stream.root = next(context)
+    depth = 1
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                stream.parent = elem
+            continue
+        depth -= 1
+        if depth == 2:
+            if ((stream.tags is None or elem.tag in stream.tags) and
+                    stream.parent.tag in stream.parent_tags):
+                yield elem
+            stream.parent.clear()
+        elif depth == 1:
+            stream.root.clear()
+
+
+def etree_elements(stream):
+    return iterparse_elements(stream, ET.iterparse(stream.osm_file, events=('start', 'end')))
+
+
+def lxml_elements(stream):
+    if lxml_etree is None:
+        raise ImportError("The lxml backend needs the lxml package")
+    if stream.tags is None or stream.parent_tags is not None:
+        return iterparse_elements(
+            stream, lxml_etree.iterparse(stream.osm_file, events=('start', 'end')))
+    return lxml_tag_elements(stream)
+
+
+def lxml_tag_elements(stream):
+    # lxml only reports the requested tags, so other elements cost next to
+    # nothing; they are dropped along with the yielded ones
+    context = lxml_etree.iterparse(stream.osm_file, events=('end',), tag=stream.tags)
+    for _, elem in context:
+        if stream.root is None:
+            stream.root = elem.getparent()
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del stream.root[0]
+
+
+class Record(object):
+    """Lightweight stand-in for an ElementTree element built by the expat
+    backend: a tag, an attribute dict and the child records"""
+
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            if child.children:
+                for elem in child.iter(tag):
+                    yield elem
+            elif tag is None or child.tag == tag:
+                yield child
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+
+class ExpatHandler(object):
+    """Build a Record per top level element, and records for its children.
+    With parent_tags, records are built one level down and collected in
+    ready as (parent, record) pairs"""
+
+    def __init__(self, tags, parent_tags=None):
+        self.tags = tags
+        self.parent_tags = parent_tags
+        self.root = None
+        self.parent = None
+        self.stack = []
+        self.ready = []
+
+    def start(self, name, attrs):
+        if self.root is None:
+            self.root = Record(name, attrs)
+        elif not self.stack:
+            if self.parent_tags is not None:
+                if self.parent is None:
+                    self.parent = Record(name, attrs)
+                    return
+                if self.parent.tag not in self.parent_tags:
+                    self.stack.append(None)
+                    return
+            keep = self.tags is None or name in self.tags
+            self.stack.append(Record(name, attrs) if keep else None)
+        elif self.stack[-1] is None:
+            # Inside a skipped top level element: only track the depth
+            self.stack.append(None)
+        else:
+            record = Record(name, attrs)
+            self.stack[-1].children.append(record)
+            self.stack.append(record)
+
+    def end(self, name):
+        if not self.stack:
+            # End of a parent, or of the root
+            self.parent = None
+            return
+        record = self.stack.pop()
+        if not self.stack and record is not None:
+            if self.parent_tags is None:
+                self.ready.append(record)
+            else:
+                self.ready.append((self.parent, record))
+
+
+def expat_elements(stream, chunk_size=2 ** 16):
+    handler = ExpatHandler(stream.tags, stream.parent_tags)
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+
+    while True:
+        data = stream.osm_file.read(chunk_size)
+        parser.Parse(data, not data)
+        stream.root = handler.root
+        if handler.ready:
+            ready, handler.ready = handler.ready, []
+            if stream.parent_tags is None:
+                for record in ready:
+                    yield record
+            else:
+                for stream.parent, record in ready:
+                    yield record
+        if not data:
+            break
+
+
+BACKENDS = {
+    'etree': etree_elements,
+    'lxml': lxml_elements,
+    'expat': expat_elements,
+}
+DEFAULT_BACKEND = 'etree'
+
+# What the backends raise on malformed XML
+PARSE_ERRORS = (ET.ParseError, expat.ExpatError)
+if lxml_etree is not None:
+    PARSE_ERRORS += (lxml_etree.XMLSyntaxError,)
+
+
+def iter_elements(osm_file, tags=None, backend=None):
+    """Yield the top level elements of osm_file whose tag is in tags"""
+    return iter(ElementStream(osm_file, tags, backend))
+
+
+def iter_spans(osm_file, block_size=2 ** 20):
+    """Yield (tag, raw bytes) for each top level node, way and relation of
+    osm_file without parsing it. A span runs from the start of its element
+    to the start of the next one, so it includes the whitespace after it.
+    Uncompressed files are memory mapped and scanned in one go, which
+    saves copying every block into a search buffer"""
+    if compression(osm_file) is None:
+        with open(osm_file, 'rb') as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file cannot be mapped
+                return
+        try:
+            for span in mapped_spans(mapped):
+                yield span
+        finally:
+            mapped.close()
+        return
+    f = open_osm(osm_file)
+    try:
+        buf = f.read(block_size)
+        tag = start = None
+        pos = 0
+        while True:
+            m = TOP_LEVEL_START.search(buf, pos)
+            if m is None:
+                data = f.read(block_size)
+                if not data:
+                    break
+                # Keep the current element and the last few bytes, in case a
+                # start tag is split across reads
+                rescan = max(pos, len(buf) - 16)
+                keep = start if start is not None else rescan
+                buf = buf[keep:] + data
+                pos = rescan - keep
+                if start is not None:
+                    start = 0
+                continue
+            if tag is not None:
+                yield tag, buf[start:m.start()]
+            tag, start = m.group(1), m.start()
+            pos = m.end()
+        if tag is not None:
+            end = buf.rfind(OSM_END, start)
+            yield tag, buf[start:end if end >= 0 else len(buf)]
+    finally:
+        f.close()
+
+
+def mapped_spans(mapped):
+    """iter_spans for a memory mapped file"""
+    tag = start = None
+    for m in TOP_LEVEL_START.finditer(mapped):
+        if tag is not None:
+            yield tag, mapped[start:m.start()]
+        tag, start = m.group(1), m.start()
+    if tag is not None:
+        end = mapped.rfind(OSM_END, start)
+        yield tag, mapped[start:end if end >= 0 else len(mapped)]
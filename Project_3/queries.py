@@ -0,0 +1,149 @@
+
+# coding: utf-8
+
+'''
+Reusable, cached versions of the sqlqueries.py reports for services that
+ask the same questions over and over. Queries take parameters instead of
+building SQL strings, so sqlite reuses the prepared statement of each query
+on every connection of a small pool. Results are cached in memory for a
+limited time, keyed by the query, its parameters and the modification time
+of the database file, so reloading or updating the database (osmdb.py,
+osmchange.py) makes earlier results stale at once.
+
+    db = OSMQueries('osmdb.db')
+    db.top_tag_values('amenity', 10)
+
+'''
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from Queue import Queue
+
+import osmdb
+
+POOL_SIZE = 4
+CACHE_SIZE = 1000
+CACHE_TTL = 300  # seconds
+STATEMENT_CACHE_SIZE = 100
+
+COUNTED_TABLES = frozenset(table for table, _ in osmdb.TABLES)
+
+TOP_TAG_VALUES_SQL = ('SELECT value, count FROM tag_value_counts WHERE key = ? '
+                      'ORDER BY count DESC, value DESC LIMIT ?')
+USER_COUNTS_SQL = ('SELECT e.user, COUNT(*) AS num '
+                   'FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e '
+                   'GROUP BY e.user')
+TOP_CONTRIBUTORS_SQL = USER_COUNTS_SQL + ' ORDER BY num DESC LIMIT ?'
+USERS_CONTRIBUTING_ONCE_SQL = 'SELECT COUNT(*) FROM (%s HAVING num = 1) u' % USER_COUNTS_SQL
+UNIQUE_USERS_SQL = ('SELECT COUNT(DISTINCT(e.uid)) '
+                    'FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) e')
+
+
+class ConnectionPool(object):
+    """A fixed number of connections to sqlite_file shared between threads.
+    Each connection keeps its own cache of prepared statements"""
+
+    def __init__(self, sqlite_file, size=POOL_SIZE):
+        self.sqlite_file = sqlite_file
+        self.idle = Queue()
+        for _ in range(size):
+            self.idle.put(sqlite3.connect(sqlite_file, check_same_thread=False,
+                                          cached_statements=STATEMENT_CACHE_SIZE))
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waiting for one to be returned if all are in use"""
+        conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+
+class QueryCache(object):
+    """Least recently used results, each valid for ttl seconds"""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """The cached result for key, or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, result)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class OSMQueries(object):
+    """The reports of sqlqueries.py over a pool of connections to
+    sqlite_file, with cached results"""
+
+    def __init__(self, sqlite_file=osmdb.SQLITE_FILE, pool_size=POOL_SIZE,
+                 cache_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.sqlite_file = sqlite_file
+        self.pool = ConnectionPool(sqlite_file, pool_size)
+        self.cache = QueryCache(cache_size, ttl)
+
+    def query(self, sql, params=()):
+        """All the rows of sql run with params, from the cache if the same
+        query was run on the current database file less than ttl ago"""
+        key = (sql, params, os.path.getmtime(self.sqlite_file))
+        rows = self.cache.get(key)
+        if rows is None:
+            with self.pool.connection() as conn:
+                rows = tuple(conn.execute(sql, params))
+            self.cache.put(key, rows)
+        # A new list each time, so that callers cannot change the cached rows
+        return list(rows)
+
+    def row_count(self, table):
+        if table not in COUNTED_TABLES:
+            raise ValueError("Unknown table %r" % table)
+        return self.query('SELECT COUNT(*) FROM %s' % table)[0][0]
+
+    def top_tag_values(self, key, limit=10):
+        """(value, count) of the node and way tags with key, most common
+        first and in reverse value order among equal counts, as sqlqueries.py
+        always listed them, all of them if limit is None"""
+        return self.query(TOP_TAG_VALUES_SQL, (key, -1 if limit is None else limit))
+
+    def top_contributors(self, limit=10):
+        """(user, number of nodes and ways) of the most active users"""
+        return self.query(TOP_CONTRIBUTORS_SQL, (limit,))
+
+    def number_of_unique_users(self):
+        return self.query(UNIQUE_USERS_SQL)[0][0]
+
+    def number_of_users_contributing_once(self):
+        return self.query(USERS_CONTRIBUTING_ONCE_SQL)[0][0]
+
+    def close(self):
+        self.pool.close()
+        self.cache.clear()
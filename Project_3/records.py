@@ -0,0 +1,40 @@
+# coding: utf-8
+
+'''
+Compact records of shaped elements, made by data.shape_record for the csv
+output when no validation is needed: attribute values in field order, tags
+as (key, value, type) tuples and way node refs in an array of integers, with
+the element id stored once. The helpers that pass records along the
+conversion pipeline (geometry.track_records, instrument.count_records)
+import the classes from here and dispatch on record.__class__
+
+'''
+
+
+class NodeRecord(object):
+    __slots__ = ('id', 'values', 'tags')
+
+    def __init__(self, id, values, tags):
+        self.id = id
+        self.values = values
+        self.tags = tags
+
+
+class WayRecord(object):
+    __slots__ = ('id', 'values', 'tags', 'node_refs')
+
+    def __init__(self, id, values, tags, node_refs):
+        self.id = id
+        self.values = values
+        self.tags = tags
+        self.node_refs = node_refs
+
+
+class RelationRecord(object):
+    __slots__ = ('id', 'values', 'tags', 'members')
+
+    def __init__(self, id, values, tags, members):
+        self.id = id
+        self.values = values
+        self.tags = tags
+        self.members = members
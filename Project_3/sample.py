@@ -8,7 +8,11 @@ Create a sample file with 5% of the data from the osm file
 
 '''
 
-import xml.etree.cElementTree as ET
+import random
+import re
+import sys
+
+import osmstream
 
 OSM_FILE = 'new_delhi.osm'
 
@@ -18,29 +22,119 @@ SAMPLE_FILE = "sample.osm"
 
 k = 20 # Parameter: take every k-th top level element
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
-    """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
-
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+# Elements are copied as raw bytes, without building or re-serializing a tree.
+# Each sampling mode makes one pass to choose the elements to keep, by their
+# position among the top level elements, and write_sample() a second one to
+# copy them.
+
+ID_RE = re.compile(r'\sid="(-?\d+)"')
+ND_REF_RE = re.compile(r'<nd\s+ref="(-?\d+)"')
+
+
+def element_id(span):
+    return ID_RE.search(span).group(1)
+
 
-    output.write('</osm>')
+def way_refs(span):
+    return ND_REF_RE.findall(span)
+
+
+class Selection(object):
+    """Positions of the chosen elements, and the nodes referenced by the
+    chosen ways for referentially closed samples"""
+
+    def __init__(self, indices, refs=()):
+        self.indices = set(indices)
+        self.node_ids = set(refs)
+
+
+def choose_stride(osm_file, k=k, closed=False):
+    """Every k-th top level element"""
+    indices = []
+    refs = []
+    for i, (tag, span) in enumerate(osmstream.iter_spans(osm_file)):
+        if i % k == 0:
+            indices.append(i)
+            if closed and tag == 'way':
+                refs.extend(way_refs(span))
+    return Selection(indices, refs)
+
+
+class Reservoir(object):
+    """Uniform random sample of `size` items from a stream of unknown length"""
+
+    def __init__(self, size, rnd):
+        self.size = size
+        self.rnd = rnd
+        self.seen = 0
+        self.items = []
+
+    def offer(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            j = self.rnd.randrange(self.seen)
+            if j < self.size:
+                self.items[j] = item
+
+
+def choose_reservoir(osm_file, size, closed=False, seed=None):
+    """size top level elements chosen uniformly at random"""
+    return choose_stratified(osm_file, {None: size}, closed, seed)
+
+
+def choose_stratified(osm_file, sizes, closed=False, seed=None):
+    """A uniform random sample per element type, of sizes[tag] elements, e.g.
+    {'node': 1000, 'way': 200, 'relation': 10}. A None key samples all types
+    together"""
+    rnd = random.Random(seed)
+    reservoirs = dict((tag, Reservoir(size, rnd)) for tag, size in sizes.iteritems())
+    for i, (tag, span) in enumerate(osmstream.iter_spans(osm_file)):
+        reservoir = reservoirs.get(tag, reservoirs.get(None))
+        if reservoir is not None:
+            refs = way_refs(span) if closed and tag == 'way' else ()
+            reservoir.offer((i, refs))
+    indices = []
+    refs = []
+    for reservoir in reservoirs.itervalues():
+        for i, way_node_ids in reservoir.items:
+            indices.append(i)
+            refs.extend(way_node_ids)
+    return Selection(indices, refs)
+
+
+def write_sample(osm_file, sample_file, selection):
+    """Copy the chosen elements, and the nodes their ways reference, to
+    sample_file in their original order"""
+    with open(sample_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+
+        for i, (tag, span) in enumerate(osmstream.iter_spans(osm_file)):
+            if i in selection.indices or (
+                    tag == 'node' and selection.node_ids and element_id(span) in selection.node_ids):
+                output.write(span.rstrip() + '\n  ')
+
+        output.write('</osm>')
+
+
+if __name__ == '__main__':
+    # Write every kth top level element, or with the arguments
+    # "reservoir <size>", "stratified <nodes> <ways> <relations>" and
+    # "closed" another kind of sample
+    args = sys.argv[1:]
+    closed = 'closed' in args
+    if 'reservoir' in args:
+        size = int(args[args.index('reservoir') + 1])
+        selection = choose_reservoir(OSM_FILE, size, closed)
+    elif 'stratified' in args:
+        i = args.index('stratified')
+        sizes = dict(zip(('node', 'way', 'relation'), map(int, args[i + 1:i + 4])))
+        selection = choose_stratified(OSM_FILE, sizes, closed)
+    else:
+        selection = choose_stride(OSM_FILE, k, closed)
+    write_sample(OSM_FILE, SAMPLE_FILE, selection)
 
 
 # In[ ]:
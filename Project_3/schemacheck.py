@@ -0,0 +1,122 @@
+
+# coding: utf-8
+
+'''
+A validator compiled from the cerberus schema in schema.py. The schema is
+turned once into plain functions doing only the type, coercion and required
+field checks it asks for, which is much cheaper than cerberus walking the
+rules anew for every element. It reports errors in the same shape as
+cerberus, so it can stand in for cerberus.Validator in data.validate_element
+
+'''
+
+TYPES = {
+    'integer': (int, long),
+    'float': (float, int, long),
+    'number': (float, int, long),
+    'string': basestring,
+    'boolean': bool,
+    'dict': dict,
+    'list': list,
+}
+
+# Only schemas built from these rules can be compiled
+RULES = frozenset(['type', 'required', 'coerce', 'nullable', 'schema'])
+
+
+def compile_field(rules):
+    """Return a function checking one value against its rules, returning a
+    list of errors, or None if the value is valid"""
+    unsupported = set(rules) - RULES
+    if unsupported:
+        raise ValueError("Cannot compile the rules %s" % ', '.join(sorted(unsupported)))
+
+    type_name = rules.get('type')
+    types = TYPES[type_name] if type_name else None
+    coerce = rules.get('coerce')
+    nullable = rules.get('nullable', False)
+    nested = None
+    if 'schema' in rules:
+        if type_name == 'list':
+            nested = compile_items(rules['schema'])
+        else:
+            nested = compile_mapping(rules['schema'])
+
+    def check(value):
+        if value is None:
+            return None if nullable else ['null value not allowed']
+        errors = None
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except Exception as e:
+                errors = ["cannot be coerced: %s" % e]
+        if types is not None and not isinstance(value, types):
+            return ['must be of %s type' % type_name] + (errors or [])
+        if nested is not None:
+            nested_errors = nested(value)
+            if nested_errors:
+                errors = (errors or []) + [nested_errors]
+        return errors
+
+    return check
+
+
+def compile_items(rules):
+    """Check every item of a list against the same rules"""
+    check_item = compile_field(rules)
+
+    def check(values):
+        errors = None
+        for i, value in enumerate(values):
+            item_errors = check_item(value)
+            if item_errors:
+                if errors is None:
+                    errors = {}
+                errors[i] = item_errors
+        return errors
+
+    return check
+
+
+def compile_mapping(schema):
+    """Check a dict against a schema of field rules: unknown fields, missing
+    required fields and the rules of each field"""
+    checks = dict((field, compile_field(rules)) for field, rules in schema.iteritems())
+    required = frozenset(field for field, rules in schema.iteritems() if rules.get('required'))
+
+    def check(document):
+        errors = None
+        for field, value in document.iteritems():
+            check_field = checks.get(field)
+            field_errors = check_field(value) if check_field else ['unknown field']
+            if field_errors:
+                if errors is None:
+                    errors = {}
+                errors[field] = field_errors
+        if not required.issubset(document):
+            if errors is None:
+                errors = {}
+            for field in required.difference(document):
+                errors[field] = ['required field']
+        return errors
+
+    return check
+
+
+class CompiledValidator(object):
+    """Validate documents against a schema compiled once. Like
+    cerberus.Validator, validate() returns True or False and leaves the
+    errors of the last document in `errors`"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.check = compile_mapping(schema)
+        self.errors = {}
+
+    def validate(self, document, schema=None):
+        if schema is not None and schema is not self.schema:
+            self.schema = schema
+            self.check = compile_mapping(schema)
+        self.errors = self.check(document) or {}
+        return not self.errors
@@ -0,0 +1,100 @@
+
+# coding: utf-8
+
+'''
+Spatial index over the nodes of osmdb.db, an SQLite R*Tree holding a point
+box per node, and the bounding box, radius and nearest neighbour queries
+built on it. Nodes can be restricted to those having a tag key, and value,
+e.g. the amenities within 1 km of Connaught Place:
+
+    nodes_within(conn, 28.6315, 77.2167, 1000, 'amenity')
+
+'''
+
+import math
+
+EARTH_RADIUS = 6371008.8  # mean radius, in metres
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# The R*Tree stores 32 bit floats rounded outwards, so it is only used to
+# find candidates, which are then checked against the exact coordinates
+SPATIAL_INDEX_SQL = [
+    'DROP TABLE IF EXISTS nodes_rtree',
+    'CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)',
+    """INSERT INTO nodes_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT id, lat, lat, lon, lon FROM nodes
+        WHERE lat IS NOT NULL AND lon IS NOT NULL""",
+]
+
+
+def refresh_spatial_index(conn):
+    """Rebuild nodes_rtree from the nodes table"""
+    with conn:
+        for sql in SPATIAL_INDEX_SQL:
+            conn.execute(sql)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres between two points given in degrees"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius):
+    """(min_lat, min_lon, max_lat, max_lon) of a box holding every point
+    within radius metres of lat, lon"""
+    dlat = radius / METRES_PER_DEGREE
+    coslat = math.cos(math.radians(min(89.9, abs(lat) + dlat)))
+    dlon = min(180, dlat / coslat)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def bbox_sql(key=None, value=None):
+    """Nodes, and the value of their key tag, overlapping a box"""
+    if key is None:
+        sql = 'SELECT n.id, n.lat, n.lon, NULL FROM nodes_rtree r JOIN nodes n ON n.id = r.id'
+    else:
+        sql = ('SELECT n.id, n.lat, n.lon, t.value FROM nodes_rtree r '
+               'JOIN nodes n ON n.id = r.id JOIN nodes_tags t ON t.id = r.id AND t.key = ?')
+        if value is not None:
+            sql += ' AND t.value = ?'
+    return sql + (' WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?'
+                  ' AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?')
+
+
+def bbox_params(min_lat, min_lon, max_lat, max_lon, key=None, value=None):
+    params = [p for p in (key, value) if p is not None]
+    return params + [min_lat, max_lat, min_lon, max_lon] * 2
+
+
+def nodes_in_bbox(conn, min_lat, min_lon, max_lat, max_lon, key=None, value=None):
+    """(id, lat, lon, tag value) of the nodes inside a box, only those with
+    a key tag (of the given value) if key is given"""
+    return conn.execute(bbox_sql(key, value),
+                        bbox_params(min_lat, min_lon, max_lat, max_lon, key, value)).fetchall()
+
+
+def nodes_within(conn, lat, lon, radius, key=None, value=None):
+    """(id, lat, lon, tag value, distance) of the nodes within radius
+    metres of lat, lon, nearest first"""
+    found = []
+    for node_id, node_lat, node_lon, tag_value in nodes_in_bbox(
+            conn, *radius_bbox(lat, lon, radius), key=key, value=value):
+        distance = haversine(lat, lon, node_lat, node_lon)
+        if distance <= radius:
+            found.append((node_id, node_lat, node_lon, tag_value, distance))
+    found.sort(key=lambda row: row[4])
+    return found
+
+
+def nearest_nodes(conn, lat, lon, k=1, key=None, value=None, radius=500):
+    """The k nodes nearest to lat, lon, as rows of nodes_within. The search
+    radius starts at radius metres and doubles until k nodes are in range,
+    as then no node outside can be nearer"""
+    while True:
+        found = nodes_within(conn, lat, lon, radius, key, value)
+        if len(found) >= k or radius > math.pi * EARTH_RADIUS:
+            return found[:k]
+        radius *= 2
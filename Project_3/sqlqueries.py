@@ -8,10 +8,16 @@ Execute different sql queries with the database created
 '''
 import sqlite3
 
+import queries
+import spatial
+
 sqlite_file = 'osmdb.db'
 conn = sqlite3.connect(sqlite_file)
 cur = conn.cursor()
 
+# The reports go through the cached, parameterized queries of queries.py
+db = queries.OSMQueries(sqlite_file)
+
 
 # In[2]:
 
@@ -19,23 +25,19 @@ cur = conn.cursor()
 
 
 def number_of_nodes():
-    result = cur.execute('SELECT COUNT(*) FROM nodes')
-    return result.fetchone()[0]
+    return db.row_count('nodes')
 print "Number of nodes: " , number_of_nodes()
 
 def number_of_ways():
-    result = cur.execute('SELECT COUNT(*) FROM ways')
-    return result.fetchone()[0]
+    return db.row_count('ways')
 print "Number of ways: " , number_of_ways()
 
 def number_of_node_tags():
-    result = cur.execute('SELECT COUNT(*) FROM nodes_tags')
-    return result.fetchone()[0]
+    return db.row_count('nodes_tags')
 print "Number of node tags: " , number_of_node_tags()
 
 def number_of_ways_tags():
-    result = cur.execute('SELECT COUNT(*) FROM ways_tags')
-    return result.fetchone()[0]
+    return db.row_count('ways_tags')
 print "Number of ways tags: " , number_of_ways_tags()
 
 
@@ -44,29 +46,30 @@ print "Number of ways tags: " , number_of_ways_tags()
 # List number of unique users, top contributing users, number of users contributing only once
 
 def number_of_unique_users():
-    result = cur.execute('SELECT COUNT(DISTINCT(e.uid))             FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) e')
-    return result.fetchone()[0]
+    return db.number_of_unique_users()
 print "Number of unique users: " , number_of_unique_users()
 
 def top_contributing_users():
-    users = []
-    for row in cur.execute('SELECT e.user, COUNT(*) as num             FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e             GROUP BY e.user             ORDER BY num DESC             LIMIT 10'):
-        users.append(row)
-    return users
+    return db.top_contributors(10)
 
 print "Top contributing users: " , top_contributing_users()
 
 def number_of_users_contributing_once():
-    result = cur.execute('SELECT COUNT(*)             FROM                 (SELECT e.user, COUNT(*) as num                  FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e                  GROUP BY e.user                  HAVING num=1) u')
-    return result.fetchone()[0]
+    return db.number_of_users_contributing_once()
 print "Number of users contributing once: " , number_of_users_contributing_once()
 
 
 # In[4]:
 
+# Most common values of a tag key, read from the tag_value_counts summary that
+# is refreshed when the database is loaded
+
+def top_tag_values(key, limit=None):
+    return db.top_tag_values(key, limit)
+
 # List postcodes in database
 
-for row in cur.execute ('SELECT t.value, COUNT(*) as count             FROM (SELECT * FROM nodes_tags UNION ALL             SELECT * FROM ways_tags) t            WHERE t.key="postcode"            GROUP BY t.value            ORDER BY count DESC            LIMIT 10;'):
+for row in top_tag_values("postcode", 10):
     print row
 
 
@@ -74,26 +77,41 @@ for row in cur.execute ('SELECT t.value, COUNT(*) as count             FROM (SEL
 
 #Top Amenities, Religions practised, Cuisine, Historical Sites
 
-for row in cur.execute ('SELECT t.value, COUNT(*) as count             FROM (SELECT * FROM nodes_tags UNION ALL             SELECT * FROM ways_tags) t            WHERE t.key="amenity"            GROUP BY t.value            ORDER BY count DESC            LIMIT 10;'):
+for row in top_tag_values("amenity", 10):
     print "Amenities:", row
     
 #Religions practised
 
-for row in cur.execute ('SELECT e.value, COUNT(*) as count             FROM (SELECT * FROM nodes_tags UNION ALL             SELECT * FROM ways_tags) e            WHERE e.key="religion"            GROUP BY e.value            ORDER BY count DESC            LIMIT 10;'):
+for row in top_tag_values("religion", 10):
     print "Religions:", row
     
 #Cuisine
 
-for row in cur.execute ('SELECT t.value, COUNT(*) as count             FROM (SELECT * FROM nodes_tags UNION ALL             SELECT * FROM ways_tags) t            WHERE t.key="cuisine"            GROUP BY t.value            ORDER BY count DESC            LIMIT 5;'):
+for row in top_tag_values("cuisine", 5):
     print "Cuisine:", row
     
 #Historical sites
 
-for row in cur.execute ('SELECT tags.value, COUNT(*) as count             FROM (SELECT * FROM nodes_tags UNION ALL             SELECT * FROM ways_tags) tags            WHERE tags.key = "historic"            GROUP BY tags.value            ORDER BY count DESC;'):
+for row in top_tag_values("historic"):
     print "Historical sites:", row
 
 
+# In[6]:
+
+# Amenities within 1 km of Connaught Place, and the 5 nearest restaurants,
+# from the spatial index over the nodes
+
+CONNAUGHT_PLACE = (28.6315, 77.2167)
+
+for node_id, lat, lon, value, distance in spatial.nodes_within(conn, CONNAUGHT_PLACE[0], CONNAUGHT_PLACE[1], 1000, 'amenity'):
+    print "Amenity within 1 km:", value, "%.0f m" % distance
+
+for node_id, lat, lon, value, distance in spatial.nearest_nodes(conn, CONNAUGHT_PLACE[0], CONNAUGHT_PLACE[1], 5, 'amenity', 'restaurant'):
+    print "Nearest restaurant:", node_id, "%.0f m" % distance
+
+
 # In[ ]:
 
+db.close()
 conn.close()
 
@@ -0,0 +1,289 @@
+
+# coding: utf-8
+
+'''
+Synthetic OSM XML files for benchmarks, of any size from a few MB to many
+GB, modelled on the New Delhi extract: nodes first, then ways, then
+relations, each in increasing id order. Most nodes are untagged corners of
+buildings and points of roads. Buildings are closed ways of four corners,
+roads run through 2 to 30 nodes, and a few tagged points of interest
+carry Delhi-style addr:street, addr:postcode and addr:city values,
+misspellings included, so the cleaners have real work to do. A few keys
+hold problem characters. Relations are multipolygons of the buildings
+and routes along the roads. Edits are spread over users with a long
+tailed distribution. The same seed and size always give the same file.
+
+    write_osm('synthetic_100mb.osm', 100 * 2 ** 20)
+
+'''
+
+import bisect
+import os
+import random
+import shutil
+from xml.sax.saxutils import quoteattr
+
+# Around New Delhi
+MIN_LAT, MAX_LAT = 28.40, 28.88
+MIN_LON, MAX_LON = 76.84, 77.35
+BLOCK_SPAN = 0.004  # degrees, about 400 m
+
+USER_COUNT = 2000
+
+# (value, weight) pairs
+STREETS = [
+    (u"Janpath", 8), (u"Rajpath", 4), (u"Chandni Chowk", 6), (u"Connaught Circus", 6),
+    (u"Counnaught Circus, Block P", 1), (u"Lodhi Road", 5), (u"Aurobindo Marg", 4),
+    (u"Mathura Road", 6), (u"mathura road", 1), (u"Khan Market", 3), (u"Ring Road", 6),
+    (u"Nehru Place", 3), (u"Arya School Ln", 1), (u"Main Bazar", 2), (u"Main bazar Pahargan", 1),
+    (u"Mahatma Gandi Road", 1), (u"Barakhamba Road", 3), (u"Prithviraj Road", 2),
+    (u"Karol Bagh", 3), (u"Sansad Marg,", 1), (u"Gali No. 10", 1), (u"MG ROAD", 1),
+]
+POSTCODES = [
+    (u"110001", 10), (u"110002", 4), (u"110003", 4), (u"110005", 3), (u"110011", 3),
+    (u"110016", 4), (u"110021", 3), (u"110065", 3), (u"110 001", 1), (u"110 021", 1),
+    (u"1100002", 1), (u"110031v", 1), (u"201301", 2), (u"100006", 1), (u"122001", 1),
+]
+CITIES = [
+    (u"New Delhi", 12), (u"Delhi", 6), (u"Delh", 1), (u"New Delhi, Delhi", 1),
+    (u"Pandav Nagar, New Delhi", 1), (u"Chanakyapuri, New Delhi", 1), (u"noida", 1),
+    (u"new delhi", 1),
+]
+AMENITIES = [
+    (u"school", 10), (u"place_of_worship", 8), (u"parking", 7), (u"hospital", 4),
+    (u"bank", 5), (u"restaurant", 6), (u"fast_food", 4), (u"fuel", 3), (u"atm", 4),
+    (u"cafe", 3), (u"pharmacy", 3), (u"toilets", 2), (u"embassy", 2), (u"bus_station", 1),
+]
+RELIGIONS = [(u"hindu", 6), (u"muslim", 3), (u"sikh", 2), (u"christian", 1), (u"jain", 1)]
+CUISINES = [(u"indian", 8), (u"north_indian", 4), (u"burger", 2), (u"pizza", 2),
+            (u"chinese", 2), (u"south_indian", 2), (u"coffee_shop", 1)]
+NAMES = [
+    (u"Shroff Eye Hospital", 1), (u"Indian National Science Academy", 1),
+    (u"Embassy of Myanmar", 1), (u"DSUI Swimming Pool", 1), (u"Press Colony", 1),
+    (u"Gurudwara Bangla Sahib", 1), (u"Jama Masjid", 1), (u"Hanuman Mandir", 1),
+    (u"State Bank of India", 2), (u"Haldiram's", 1), (u"Karim's", 1), (u"Sagar Ratna", 1),
+    (u"Kendriya Vidyalaya", 2), (u"Indian Oil", 1), (u"Apollo Pharmacy", 1),
+]
+HINDI_NAMES = [(u"नई दिल्ली", 1), (u"जनपथ", 1), (u"चाँदनी चौक", 1), (u"कनॉट प्लेस", 1)]
+ROAD_NAMES = [
+    (u"Mahatma Gandhi Marg", 6), (u"Vikas Marg", 2), (u"Teen Murti Marg", 2),
+    (u"Dadri Road", 2), (u"Deshbandhu Gupta Road", 1), (u"Ashok Road", 2),
+    (u"Kasturba Gandhi Marg", 2), (u"Bhishma Pitamah Marg", 1), (u"Outer Ring Road", 2),
+]
+HIGHWAYS = [
+    (u"residential", 164), (u"service", 37), (u"footway", 28), (u"tertiary", 24),
+    (u"secondary", 19), (u"unclassified", 15), (u"living_street", 5), (u"primary", 5),
+    (u"trunk", 2),
+]
+BUILDINGS = [(u"yes", 1800), (u"commercial", 6), (u"apartments", 4), (u"residential", 4),
+             (u"school", 2), (u"house", 2)]
+LANDUSES = [(u"residential", 16), (u"commercial", 7), (u"industrial", 2), (u"grass", 1)]
+# Keys with problem characters, dropped by data.py
+PROBLEM_KEYS = [(u"name.en", 2), (u"fixme?", 1), (u"addr street", 1), (u"note#1", 1)]
+VERSIONS = [(1, 30), (2, 25), (3, 15), (4, 10), (5, 8), (6, 5), (8, 4), (12, 2), (52, 1)]
+
+
+class Choice(object):
+    """Pick values at random with the given weights"""
+
+    def __init__(self, weighted):
+        self.values = [value for value, _ in weighted]
+        self.totals = []
+        total = 0
+        for _, weight in weighted:
+            total += weight
+            self.totals.append(total)
+        self.total = total
+
+    def __call__(self, rnd):
+        return self.values[bisect.bisect_right(self.totals, rnd.random() * self.total)]
+
+
+def attr(value):
+    """A quoted and escaped XML attribute value, utf-8 encoded"""
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return quoteattr(value, {'\n': '&#10;'}).encode('utf-8')
+
+
+def tag_choice(weighted):
+    """Choice of pre-quoted attribute values"""
+    return Choice([(attr(value), weight) for value, weight in weighted])
+
+
+class Generator(object):
+    """The elements of a synthetic file, one block of about a city block at
+    a time. Nodes, ways and relations are written to separate files, so that
+    they can be concatenated in OSM order"""
+
+    def __init__(self, seed=0):
+        self.rnd = random.Random(seed)
+        rnd = self.rnd
+        self.users = Choice([((i + 1, attr(u'mapper_%d' % (i + 1) if i % 7 else
+                                            u"n'garh %d" % (i + 1))), 1.0 / (i + 1))
+                             for i in range(USER_COUNT)])
+        self.timestamps = ['"%d-%02d-%02dT%02d:%02d:%02dZ"' % (
+            rnd.randint(2009, 2016), rnd.randint(1, 12), rnd.randint(1, 28),
+            rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59)) for _ in range(5000)]
+        self.versions = Choice(VERSIONS)
+        self.choices = dict((name, tag_choice(weighted)) for name, weighted in [
+            ('street', STREETS), ('postcode', POSTCODES), ('city', CITIES),
+            ('amenity', AMENITIES), ('religion', RELIGIONS), ('cuisine', CUISINES),
+            ('name', NAMES), ('name:hi', HINDI_NAMES), ('road', ROAD_NAMES),
+            ('highway', HIGHWAYS), ('building', BUILDINGS), ('landuse', LANDUSES),
+            ('problem', PROBLEM_KEYS)])
+        self.node_id = 1
+        self.way_id = 1
+        self.relation_id = 1
+        self.routes = []
+        self.counts = dict((counter, 0) for counter in
+                           ('nodes', 'ways', 'relations', 'tags', 'nd_refs', 'members'))
+
+    def meta(self, element_id):
+        """The id, changeset, user and other attributes of an element"""
+        rnd = self.rnd
+        uid, user = self.users(rnd)
+        return 'changeset="%d" id="%d" timestamp=%s uid="%d" user=%s version="%d"' % (
+            rnd.randint(1000000, 43000000), element_id, rnd.choice(self.timestamps), uid,
+            user, self.versions(rnd))
+
+    def tag_lines(self, tags):
+        self.counts['tags'] += len(tags)
+        return ''.join('    <tag k=%s v=%s />\n' % tag for tag in tags)
+
+    def node(self, out, lat, lon, tags=()):
+        node_id = self.node_id
+        self.node_id += 1
+        self.counts['nodes'] += 1
+        head = '  <node %s lat="%.7f" lon="%.7f"' % (self.meta(node_id), lat, lon)
+        if tags:
+            out.append('%s>\n%s  </node>\n' % (head, self.tag_lines(tags)))
+        else:
+            out.append(head + ' />\n')
+        return node_id
+
+    def way(self, out, refs, tags):
+        way_id = self.way_id
+        self.way_id += 1
+        self.counts['ways'] += 1
+        self.counts['nd_refs'] += len(refs)
+        out.append('  <way %s>\n%s%s  </way>\n' % (
+            self.meta(way_id), ''.join('    <nd ref="%d" />\n' % ref for ref in refs),
+            self.tag_lines(tags)))
+        return way_id
+
+    def relation(self, out, members, tags):
+        relation_id = self.relation_id
+        self.relation_id += 1
+        self.counts['relations'] += 1
+        self.counts['members'] += len(members)
+        out.append('  <relation %s>\n%s%s  </relation>\n' % (
+            self.meta(relation_id),
+            ''.join('    <member ref="%d" role="%s" type="%s" />\n' % member
+                    for member in members), self.tag_lines(tags)))
+        return relation_id
+
+    def point_tags(self):
+        """Tags of a point of interest, addresses included"""
+        rnd, choice = self.rnd, self.choices
+        amenity = choice['amenity'](rnd)
+        tags = [('"amenity"', amenity), ('"name"', choice['name'](rnd))]
+        if amenity == '"place_of_worship"':
+            tags.append(('"religion"', choice['religion'](rnd)))
+        elif amenity in ('"restaurant"', '"fast_food"', '"cafe"'):
+            tags.append(('"cuisine"', choice['cuisine'](rnd)))
+        if rnd.random() < 0.6:
+            tags.append(('"addr:street"', choice['street'](rnd)))
+        if rnd.random() < 0.4:
+            tags.append(('"addr:postcode"', choice['postcode'](rnd)))
+        if rnd.random() < 0.4:
+            tags.append(('"addr:city"', choice['city'](rnd)))
+        if rnd.random() < 0.1:
+            tags.append(('"name:hi"', choice['name:hi'](rnd)))
+        if rnd.random() < 0.05:
+            tags.append((choice['problem'](rnd), '"1"'))
+        return tags
+
+    def block(self, nodes, ways, relations):
+        """Write the elements of one block to the nodes, ways and relations
+        lists of strings"""
+        rnd, choice = self.rnd, self.choices
+        lat = rnd.uniform(MIN_LAT, MAX_LAT - BLOCK_SPAN)
+        lon = rnd.uniform(MIN_LON, MAX_LON - BLOCK_SPAN)
+        point = lambda: (lat + rnd.random() * BLOCK_SPAN, lon + rnd.random() * BLOCK_SPAN)
+
+        buildings = []
+        for _ in range(rnd.randint(20, 60)):
+            b_lat, b_lon = point()
+            size = rnd.uniform(0.00005, 0.0002)
+            corners = [self.node(nodes, b_lat + dlat, b_lon + dlon)
+                       for dlat, dlon in ((0, 0), (0, size), (size, size), (size, 0))]
+            tags = [('"building"', choice['building'](rnd))]
+            if rnd.random() < 0.05:
+                tags.extend([('"addr:street"', choice['street'](rnd)),
+                             ('"addr:postcode"', choice['postcode'](rnd))])
+            buildings.append(self.way(ways, corners + corners[:1], tags))
+
+        roads = []
+        for _ in range(rnd.randint(1, 4)):
+            refs = [self.node(nodes, *point()) for _ in range(rnd.randint(2, 30))]
+            tags = [('"highway"', choice['highway'](rnd))]
+            if rnd.random() < 0.3:
+                tags.append(('"name"', choice['road'](rnd)))
+            if rnd.random() < 0.15:
+                tags.append(('"oneway"', '"yes"'))
+            roads.append(self.way(ways, refs, tags))
+
+        for _ in range(rnd.randint(0, 5)):
+            self.node(nodes, *point(), tags=self.point_tags())
+
+        if rnd.random() < 0.3:
+            refs = [self.node(nodes, *point()) for _ in range(rnd.randint(4, 12))]
+            self.way(ways, refs + refs[:1], [('"landuse"', choice['landuse'](rnd))])
+
+        if rnd.random() < 0.1:
+            parts = rnd.sample(buildings, min(len(buildings), rnd.randint(2, 5)))
+            members = [(parts[0], 'outer', 'way')] + [(way_id, 'inner', 'way')
+                                                      for way_id in parts[1:]]
+            self.relation(relations, members, [('"type"', '"multipolygon"'),
+                                               ('"building"', '"yes"')])
+        self.routes.extend(roads)
+        if len(self.routes) >= 200:
+            members = [(way_id, '', 'way') for way_id in self.routes]
+            self.relation(relations, members, [('"type"', '"route"'), ('"route"', '"bus"'),
+                                               ('"name"', choice['road'](rnd))])
+            self.routes = []
+
+
+def write_osm(path, size_bytes, seed=0, blocks_per_write=20):
+    """Write a synthetic OSM XML file of about size_bytes to path. Return
+    the number of nodes, ways, relations, tags, way node refs and relation
+    members written, and the size of the file"""
+    generator = Generator(seed)
+    ways_path, relations_path = path + '.ways.tmp', path + '.relations.tmp'
+    written = 0
+    try:
+        with open(path, 'wb') as node_file, open(ways_path, 'wb') as way_file, \
+                open(relations_path, 'wb') as relation_file:
+            node_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n')
+            while written < size_bytes:
+                nodes, ways, relations = [], [], []
+                for _ in range(blocks_per_write):
+                    generator.block(nodes, ways, relations)
+                for out, chunk in ((node_file, nodes), (way_file, ways),
+                                   (relation_file, relations)):
+                    text = ''.join(chunk)
+                    out.write(text)
+                    written += len(text)
+        with open(path, 'ab') as f:
+            for part in (ways_path, relations_path):
+                with open(part, 'rb') as elements:
+                    shutil.copyfileobj(elements, f, 2 ** 20)
+            f.write('</osm>\n')
+    finally:
+        for part in (ways_path, relations_path):
+            if os.path.exists(part):
+                os.remove(part)
+    counts = dict(generator.counts)
+    counts['bytes'] = os.path.getsize(path)
+    return counts